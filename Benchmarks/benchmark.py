@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import importlib.util
+import urllib.parse
+import pandas as pd
+
+"""
+Benchmark each stage of every league table script against synthetic data, without touching publisher websites or the checked-in files.
+Synthetic tables are generated at a configurable scale (institutions × subjects × metrics × years) in each publisher's raw format:
+    • Times & Sunday Times JSON, QS and THE JSON (with the HTML pages used to find them), CUG HTML pages and Guardian Excel workbooks
+    • Fetch stages are served from memory by a stand-in for requests, so they measure parsing and saving rather than the network
+    • Each pipeline is run twice, once for wall time and once with tracemalloc for peak memory (tracing slows Python down)
+    • The final output of each pipeline is also passed through add_ukprn() and add_group_ranks() from lt_name_ukprn.py
+Results can be saved as a CSV and compared with an earlier run, e.g.:
+    python3 benchmark.py --institutions 200 --output baseline.csv
+    python3 benchmark.py --institutions 200 --baseline baseline.csv --tolerance 0.25
+Any stage slower than the baseline by more than the tolerance is reported and the script exits with status 1.
+"""
+
+root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+times_metrics = ["Teaching quality (%)", "Student experience (%)", "Research quality (%)", "Entry standards (Ucas pts)", "Graduate prospects (%)", "Completion rate (%)", "Student-staff ratio", "Services/facilities spend (£)", "Total"]
+qs_institutional_metrics = ["Academic Reputation", "Employer Reputation", "Faculty Student", "International Faculty", "International Students", "Citations per Faculty"]
+qs_subject_metrics = ["Academic Reputation", "Employer Reputation", "Citations per Paper", "H-index Citations"]
+the_metrics = ["scores_teaching", "scores_research", "scores_citations", "scores_industry_income", "scores_international_outlook"]
+cug_metrics = ["Entry Standards", "Student Satisfaction", "Research Quality", "Graduate Prospects", "Student-Staff Ratio", "Academic Services Spend", "Facilities Spend", "Good Honours", "Degree Completion", "Overall Score"]
+guardian_institutional_metrics = ["NSS Teaching (%)", "NSS Overall (%)", "Continuation", "Expenditure per student / 10", "Student:staff ratio", "Career prospects (%)", "Value added score/10", "Entry Tariff", "NSS Feedback (%)"]
+guardian_subject_metrics = ["Guardian score/100", "% Satisfied with Teaching", "% Satisfied with course", "Continuation", "Expenditure per student (FTE)", "Student:staff ratio", "Career prospects", "Value added score/10", "Average Entry Tariff"]
+
+def metric_names(known, metrics):
+    """
+    Use the publisher's own metric names first, then made-up names (which the scripts filter out) to reach the requested number
+    """
+    return (known + ["Metric {}".format(m) for m in range(metrics)])[:metrics]
+
+def institution_names(institutions):
+    return ["University of Place {}".format(i) for i in range(institutions)]
+
+def scores(rng, institutions):
+    return sorted([round(rng.uniform(10, 100), 1) for i in range(institutions)], reverse=True)
+
+def banded_rank(position):
+    """
+    Rank as published by the international tables, banded beyond 200
+    """
+    if position <= 200:
+        return str(position)
+    if position > 1000:
+        return "1001+"
+    lower = (position - 1) // 50 * 50 + 1
+    return "{}–{}".format(lower, lower + 49)
+
+class SyntheticResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.status_code = 200 if payload is not None else 404
+        self.text = payload if isinstance(payload, str) else json.dumps(payload)
+
+    def __bool__(self):
+        return self.status_code == 200
+
+    def json(self):
+        return json.loads(self.text)
+
+class SyntheticRequests:
+    """
+    Stands in for the requests module, answering each known URL with a generated payload and anything else with a 404
+    """
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, **kwargs):
+        return SyntheticResponse(self.pages.get(url))
+
+def times_table(rng, institutions, metrics, table_name, subject):
+    headers = (["Subject rank", "Overall rank", "Institution"] if subject else ["Rank", "Last Year Rank", "University"]) + metric_names(times_metrics, metrics)
+    columns = [{"name": h.lower().replace(" ", "_"), "header": h, "id": h.lower().replace(" ", "-")} for h in headers]
+    values = [scores(rng, institutions) for m in range(metrics)]
+    rows = []
+    for i, name in enumerate(institution_names(institutions)):
+        link = '<a class="tableLink" href="/education/university_guide/active/UniversityGuide/university/id/{}">{}</a>'.format(i, name)
+        rows.append([str(i + 1), str(i + 1), link] + ["{:,}".format(v[i]) for v in values])
+    return {"table_name": table_name, "columns": columns, "rows": rows}
+
+def times_institutional(rng, scale, base_url):
+    url = base_url + "/education/university_guide/active/UniversityGuide/getTable/type/rank/year/"
+    return {url + str(year): times_table(rng, scale.institutions, scale.metrics, "Overall institutional ranking", False) for year in scale.years}
+
+def times_subjects(rng, scale, base_url):
+    url = base_url + "/education/university_guide/active/UniversityGuide/getTable/type/imported/year"
+    pages = {}
+    for year in scale.years:
+        for subject in range(min(scale.subjects, 200)): # The script probes IDs 300 to 499
+            pages["{}/{}/id/{}".format(url, year, 300 + subject)] = times_table(rng, scale.institutions, scale.metrics, "Subject {}".format(subject), True)
+    return pages
+
+def qs_cell(value, rank=False):
+    if rank:
+        return '<div class="td-wrap"><div class="td-wrap-in"><div class="bg "><span class="rank ">{}</span></div></div></div>'.format(value)
+    return '<div class="td-wrap"><div class="td-wrap-in">{}</div></div>'.format(value)
+
+def qs_table(rng, institutions, metrics, known):
+    names = metric_names(known, metrics)
+    columns = [
+        {"data": "region", "title": "REGION"},
+        {"data": "location", "title": "LOCATION"},
+        {"data": "overall_rank", "title": "# RANK"},
+        {"data": "overall_rank_dis", "title": "# RANK"},
+        {"data": "uni", "title": "UNIVERSITY"},
+        {"data": "overall", "title": '<div class="td-wrap"><div class="labl"><div>OVERALL SCORE</div></div></div>'},
+        {"data": "stars", "title": "STARS"}
+    ]
+    for m, name in enumerate(names):
+        columns.append({"data": str(m), "title": '<div class="td-wrap"><div class="labl"><div>{}</div></div></div>'.format(name)})
+        columns.append({"data": "{}_rank_d".format(m), "title": "SCORE"})
+    values = [scores(rng, institutions) for m in range(metrics + 1)]
+    data = []
+    for i, name in enumerate(institution_names(institutions)):
+        row = {
+            "region": "Europe",
+            "location": "United Kingdom" if i % 4 == 0 else "Elsewhere",
+            "overall_rank": str(i + 1),
+            "overall_rank_dis": qs_cell(banded_rank(i + 1), rank=True),
+            "uni": '<div class="td-wrap"><div class="td-wrap-in"><a href="/universities/{}">{}</a></div></div>'.format(i, name),
+            "overall": qs_cell(values[-1][i]),
+            "stars": ""
+        }
+        for m in range(metrics):
+            row[str(m)] = qs_cell(values[m][i])
+            row["{}_rank_d".format(m)] = qs_cell(i + 1, rank=True)
+        data.append(row)
+    return {"columns": columns, "data": data}
+
+def qs_institutional(rng, scale, base_url):
+    pages = {}
+    for year in scale.years:
+        indicators = "{}0_indicators.txt".format(year)
+        pages[base_url + "/university-rankings/world-university-rankings/{}".format(year)] = "<script>{}</script>".format(indicators)
+        pages[base_url + "/sites/default/files/qs-rankings-data/" + indicators] = qs_table(rng, scale.institutions, scale.metrics, qs_institutional_metrics)
+    return pages
+
+def qs_subjects(rng, scale, base_url):
+    pages = {}
+    lookup = []
+    for subject in range(scale.subjects):
+        slug = "subject-{}".format(subject)
+        lookup.append(dict([("Category", "Category"), ("Subject", "Subject {}".format(subject))] + [(str(year), slug) for year in scale.years]))
+        for year in scale.years:
+            indicators = "{}{}_indicators.txt".format(year, subject)
+            pages[base_url + "/university-rankings/university-subject-rankings/{}/{}".format(year, slug)] = "<script>{}</script>".format(indicators)
+            pages[base_url + "/sites/default/files/qs-rankings-data/" + indicators] = qs_table(rng, scale.institutions, scale.metrics, qs_subject_metrics)
+    pd.DataFrame(lookup).to_csv("lookup.csv", index=False)
+    return pages
+
+def the_table(rng, institutions, metrics):
+    names = metric_names(the_metrics, metrics)
+    values = [scores(rng, institutions) for m in range(metrics + 1)]
+    data = []
+    for i, name in enumerate(institution_names(institutions)):
+        row = {"rank_order": str((i + 1) * 10), "rank": banded_rank(i + 1), "name": name, "location": "United Kingdom" if i % 4 == 0 else "Elsewhere"}
+        row["scores_overall"] = str(values[-1][i]) if i < 200 else "{}–{}".format(values[-1][i], values[-1][i] + 5)
+        for m, metric in enumerate(names):
+            row[metric] = str(values[m][i])
+            row[metric + "_rank"] = str(i + 1)
+        data.append(row)
+    return {"data": data}
+
+def the_institutional(rng, scale, base_url):
+    pages = {}
+    for year in scale.years:
+        pages[base_url + "/world-university-rankings/{}/world-ranking".format(year)] = '"world_university_rankings_{}.json"'.format(year)
+        pages[base_url + "/sites/default/files/the_data_rankings/world_university_rankings_{}.json".format(year)] = the_table(rng, scale.institutions, scale.metrics)
+    return pages
+
+def the_subjects(rng, scale, base_url):
+    """
+    The THE script has a fixed list of subjects, so the subjects setting doesn't apply
+    """
+    pages = {}
+    subjects = load_script(pipelines["THE WUR Subjects"][0]).subjects
+    for year in scale.years:
+        for slug in subjects.values():
+            json_name = "{}_{}.json".format(slug.replace("-", "_"), year)
+            pages[base_url + "/world-university-rankings/{}/subject-ranking/{}".format(year, slug)] = '"the_data_rankings\\/{}"'.format(json_name)
+            pages[base_url + "/sites/default/files/the_data_rankings/" + json_name] = the_table(rng, scale.institutions, scale.metrics)
+    return pages
+
+def cug_page(rng, institutions, metrics):
+    names = ["Rank", "University Name"] + metric_names(cug_metrics, metrics)
+    values = [scores(rng, institutions) for m in range(metrics)]
+    rows = ["<tr>{}</tr>".format("".join("<th>{}</th>".format(n) for n in names))]
+    for i, name in enumerate(institution_names(institutions)):
+        cells = [str(i + 1), name] + ["{:,}".format(v[i]) if i % 20 else "n/a" for v in values]
+        rows.append("<tr>{}</tr>".format("".join("<td>{}</td>".format(c) for c in cells)))
+    return '<html><body><table class="league-table-table">{}</table></body></html>'.format("".join(rows))
+
+def cug_institutional(rng, scale, base_url):
+    url = base_url + "/league-tables/rankings?v=wide&y="
+    return {url + str(year): cug_page(rng, scale.institutions, scale.metrics) for year in scale.years}
+
+def cug_subjects(rng, scale, base_url):
+    url = base_url + "/league-tables/rankings?v=wide&y="
+    subjects = ["Subject {}".format(s) for s in range(scale.subjects)]
+    pd.DataFrame({"Subject": subjects}).to_csv("lookup.csv", index=False)
+    return {url + str(year) + "&s=" + urllib.parse.quote(subject): cug_page(rng, scale.institutions, scale.metrics) for year in scale.years for subject in subjects}
+
+def guardian_sheet(rng, institutions, metrics, known, name_column):
+    names = metric_names(known, metrics)
+    sheet = pd.DataFrame({name_column: institution_names(institutions)})
+    for metric in names:
+        sheet[metric] = scores(rng, institutions)
+    return sheet
+
+def guardian(rng, scale, base_url):
+    """
+    Write a workbook per year with an institutional sheet and one sheet per subject, plus a matching lookup.csv
+    """
+    os.makedirs("Originals")
+    lookup = {}
+    subjects = ["S{:03d} Subject {}".format((s + 1) * 10, s) for s in range(scale.subjects)]
+    for year in scale.years:
+        filename = "Guardian {}.xlsx".format(year)
+        with pd.ExcelWriter(os.path.join("Originals", filename)) as writer:
+            guardian_sheet(rng, scale.institutions, scale.metrics, guardian_institutional_metrics, "Name of Provider").to_excel(writer, sheet_name="Institutional", index=False)
+            for subject in subjects:
+                sheet = guardian_sheet(rng, scale.institutions, scale.metrics, guardian_subject_metrics, "Name of Institution")
+                sheet.to_excel(writer, sheet_name=subject[:9], index=False, startrow=1) # Subject tables have a title row above the header
+        lookup[str(year)] = dict([("Filename", filename), ("Institutional", "Institutional"), ("Institutional Header", 0), ("Human Geo", None)] + [(s, s[:9]) for s in subjects])
+    pd.DataFrame(lookup).to_csv("lookup.csv")
+    return {}
+
+pipelines = {
+    "Times & Sunday Times Institutional": (os.path.join("Times and Sunday Times", "Institutional", "times_institutional.py"), times_institutional, ["fetch_json", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "Times & Sunday Times Subjects": (os.path.join("Times and Sunday Times", "Subjects", "times_subjects.py"), times_subjects, ["fetch_json", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "QS WUR Institutional": (os.path.join("QS", "World University Rankings", "Institutional", "qs_institutional.py"), qs_institutional, ["fetch_json", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "QS WUR Subjects": (os.path.join("QS", "World University Rankings", "Subjects", "qs_subjects.py"), qs_subjects, ["fetch_json", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "THE WUR Institutional": (os.path.join("Times Higher Education", "World University Rankings", "Institutional", "the_institutional.py"), the_institutional, ["fetch_json", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "THE WUR Subjects": (os.path.join("Times Higher Education", "World University Rankings", "Subjects", "the_subjects.py"), the_subjects, ["fetch_json", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "Complete University Guide Institutional": (os.path.join("Complete University Guide", "Institutional", "cug_institutional.py"), cug_institutional, ["get_data", "clean_data", "rank_metrics"]),
+    "Complete University Guide Subjects": (os.path.join("Complete University Guide", "Subjects", "cug_subjects.py"), cug_subjects, ["get_data", "clean_data", "rank_metrics"]),
+    "Guardian Institutional": (os.path.join("Guardian", "guardian_institutional.py"), guardian, ["check_schema", "concat_data", "clean_data", "rank_metrics"]),
+    "Guardian Subjects": (os.path.join("Guardian", "guardian_subjects.py"), guardian, ["check_schema", "concat_data", "clean_data", "rank_metrics"])
+}
+
+def load_script(path):
+    """
+    Import a league table script from its file (the folder names aren't valid package names)
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(func, args, trace):
+    """
+    Call a stage, returning its output, wall time in seconds and (if tracing) peak memory in MB
+    """
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        output = func(*args)
+        return output, time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 1024 ** 2 if trace else None
+    finally:
+        tracemalloc.stop()
+
+def run_stages(module, ukprn, stages, years, trace):
+    """
+    Run each stage on the output of the previous one (or on the years for stages which read from disk), returning a result per stage
+    """
+    results = []
+    data = None
+    for stage in stages:
+        output, wall, peak = measure(getattr(module, stage), [years] if data is None else [data], trace)
+        if output is not None:
+            data = output
+        results.append({"Stage": stage, "Seconds": wall, "Peak MB": peak, "Rows": len(data) if data is not None else None})
+    data.to_csv("output.csv", index=False)
+    names = pd.DataFrame({"LT Name": data["Institution"].unique()})
+    names["UKPRN"] = range(10000000, 10000000 + len(names))
+    institutions = names.rename(columns={"LT Name": "VIEW_NAME"})
+    institutions["GROUPS"] = ["Russell_Group" if i % 5 == 0 else "" for i in range(len(institutions))]
+    institutions.to_csv("learning-providers-plus.csv", index=False)
+    for stage, args in [("add_ukprn", [["output.csv"], [], names]), ("add_group_ranks", [["output.csv"], []])]:
+        output, wall, peak = measure(getattr(ukprn, stage), args, trace)
+        results.append({"Stage": stage, "Seconds": wall, "Peak MB": peak, "Rows": len(data)})
+    return results
+
+def benchmark(name, scale, ukprn):
+    """
+    Generate synthetic raw data for one pipeline in a temporary folder and time (then trace) each of its stages
+    """
+    path, generator, stages = pipelines[name]
+    module = load_script(path)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            rng = random.Random(scale.seed)
+            pages = generator(rng, scale, getattr(module, "base_url", None)) # Pages are keyed on the script's own base URL (e.g. the mock server's if set)
+            module.requests = SyntheticRequests(pages)
+            module.save_fetched = True # Fetched tables are saved in the temporary folder whichever base URL is set
+            timed = run_stages(module, ukprn, stages, scale.years, False)
+            traced = run_stages(module, ukprn, stages, scale.years, True)
+        finally:
+            os.chdir(cwd)
+    results = pd.DataFrame(timed)
+    results["Peak MB"] = [r["Peak MB"] for r in traced]
+    results["Rows"] = results["Rows"].astype("Int64")
+    results.insert(0, "Pipeline", name)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    List the stages which are slower than in the baseline by more than the tolerance
+    """
+    baseline = pd.read_csv(baseline)
+    merged = results.merge(baseline[["Pipeline", "Stage", "Seconds"]], on=["Pipeline", "Stage"], suffixes=("", " Baseline"))
+    merged["Change"] = merged["Seconds"] / merged["Seconds Baseline"] - 1
+    return merged.loc[merged["Change"] > tolerance]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark league table scripts on synthetic data")
+    parser.add_argument("--institutions", type=int, default=100)
+    parser.add_argument("--subjects", type=int, default=5)
+    parser.add_argument("--metrics", type=int, default=8)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pipelines", nargs="*", default=list(pipelines), help="Names of pipelines to run (default all)")
+    parser.add_argument("--output", help="Save results to this CSV file")
+    parser.add_argument("--baseline", help="Compare with results saved by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fractional slowdown against the baseline to report")
+    scale = parser.parse_args()
+    scale.years = list(range(2020 - scale.years + 1, 2021))
+    ukprn = load_script(os.path.join("LT Name to UKPRN", "lt_name_ukprn.py"))
+    results = pd.concat([benchmark(name, scale, ukprn) for name in scale.pipelines], ignore_index=True)
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+    if scale.output:
+        results.to_csv(scale.output, index=False)
+    if scale.baseline:
+        slower = compare(results, scale.baseline, scale.tolerance)
+        if len(slower):
+            print("\nSlower than baseline:")
+            print(slower.to_string(index=False, float_format="{:.3f}".format))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+"""
+Publishers sometimes revise earlier years' tables, so this script finds what has changed in each dataset since it was last run.
+Run it after the league table scripts:
+    • The raw payloads (JSON files or Guardian workbooks) and the ranked output are fingerprinted by (Year, Subject) partition (or by year where a payload covers a whole year)
+    • Fingerprints are compared with those saved by the previous run (in the 'State' folder), along with a compressed copy of the previous output
+    • Only partitions whose fingerprint differs are compared row by row
+    • Added, removed and changed rows are saved with a 'Change' field as e.g. 'Times & Sunday Times Subject changes.csv' alongside the dataset
+    • The changes file is rewritten on every run (with just a header if nothing has changed), so it only ever holds the latest run's changes
+The first run of each dataset only records its state (and saves an empty changes file).
+"""
+
+datasets = [
+    (os.path.join("..", "Complete University Guide", "Institutional", "Complete University Guide Institutional.csv"), None),
+    (os.path.join("..", "Complete University Guide", "Subjects", "Complete University Guide Subjects.csv"), None),
+    (os.path.join("..", "Guardian", "Guardian Institutional.csv"), os.path.join("..", "Guardian", "Originals", "*.xlsx")),
+    (os.path.join("..", "Guardian", "Guardian Subjects.csv"), os.path.join("..", "Guardian", "Originals", "*.xlsx")),
+    (os.path.join("..", "Times and Sunday Times", "Institutional", "Times & Sunday Times Institutional.csv"), os.path.join("..", "Times and Sunday Times", "Institutional", "JSON", "*.json")),
+    (os.path.join("..", "Times and Sunday Times", "Subjects", "Times & Sunday Times Subject.csv"), os.path.join("..", "Times and Sunday Times", "Subjects", "JSON", "*", "*.json")),
+    (os.path.join("..", "QS", "World University Rankings", "Institutional", "QS WUR Institutional.csv"), os.path.join("..", "QS", "World University Rankings", "Institutional", "JSON", "*.json")),
+    (os.path.join("..", "QS", "World University Rankings", "Subjects", "QS WUR Subjects.csv"), os.path.join("..", "QS", "World University Rankings", "Subjects", "JSON", "*", "*.json")),
+    (os.path.join("..", "Times Higher Education", "World University Rankings", "Institutional", "THE WUR Institutional.csv"), os.path.join("..", "Times Higher Education", "World University Rankings", "Institutional", "JSON", "*.json")),
+    (os.path.join("..", "Times Higher Education", "World University Rankings", "Subjects", "THE WUR Subjects.csv"), os.path.join("..", "Times Higher Education", "World University Rankings", "Subjects", "JSON", "*", "*.json"))
+]
+
+key_columns = ["Year", "Subject", "Subject Code", "Location", "Institution", "Metric"]
+
+year_spec = re.compile(r"(?:19|20)\d\d") # Years in raw payload folder and file names
+
+def raw_partition(path):
+    """
+    Partition a raw payload belongs to: 'Year|Subject' for files in a year's folder, otherwise the year in the filename
+    """
+    folder = os.path.basename(os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0]
+    if year_spec.fullmatch(folder):
+        return "{}|{}".format(folder, name)
+    years = year_spec.findall(name)
+    return years[-1] if years else name
+
+def raw_fingerprints(pattern):
+    """
+    Hash the raw payload files matching the pattern, combined for each partition
+    """
+    hashes = {}
+    for file in sorted(glob.glob(pattern)) if pattern else []:
+        with open(file, "rb") as f:
+            hashes.setdefault(raw_partition(file), []).append(hashlib.sha1(f.read()).hexdigest())
+    return {partition: hashlib.sha1("".join(sorted(h)).encode()).hexdigest() for partition, h in hashes.items()}
+
+def partition_keys(data):
+    return [c for c in ["Year", "Subject"] if c in data.columns]
+
+def partition_name(key):
+    return "|".join(str(k) for k in key) if isinstance(key, tuple) else str(key)
+
+def output_fingerprints(data):
+    """
+    Hash each (Year, Subject) partition of a ranked dataset, independently of row order
+    """
+    hashes = pd.util.hash_pandas_object(data, index=False).values
+    fingerprints = {}
+    for key, rows in data.groupby(partition_keys(data)).indices.items():
+        fingerprints[partition_name(key)] = hashlib.sha1(np.sort(hashes[rows]).tobytes()).hexdigest()
+    return fingerprints
+
+def changed(fingerprints, previous_fingerprints):
+    return sorted(p for p in set(fingerprints) | set(previous_fingerprints) if fingerprints.get(p) != previous_fingerprints.get(p))
+
+def in_partitions(data, partitions):
+    names = data[partition_keys(data)].astype(str).apply("|".join, axis=1) if len(data) else pd.Series(dtype=str)
+    return data.loc[names.isin(partitions).values]
+
+def compare_rows(previous, current):
+    """
+    Match rows on their key columns, returning added, removed and changed rows with a 'Change' field
+    """
+    keys = [c for c in key_columns if c in current.columns]
+    values = [c for c in current.columns if c not in keys]
+    merged = previous.merge(current, how="outer", on=keys, suffixes=(" Previous", ""), indicator=True)
+    added = merged.loc[merged["_merge"] == "right_only", keys + values].assign(Change="added")
+    removed = merged.loc[merged["_merge"] == "left_only"]
+    removed = removed[keys + [c + " Previous" for c in values]].rename(columns=lambda c: c.replace(" Previous", "")).assign(Change="removed")
+    both = merged.loc[merged["_merge"] == "both"]
+    differs = pd.Series(False, index=both.index)
+    for c in values:
+        differs |= (both[c] != both[c + " Previous"]) & ~(both[c].isnull() & both[c + " Previous"].isnull())
+    changed = both.loc[differs, keys + values].assign(Change="changed")
+    return pd.concat([added, removed, changed], axis=0)
+
+def find_changes(file, pattern):
+    """
+    Compare a dataset with its state from the previous run, save any changes and record the new state
+    """
+    name = re.sub(r"\.csv(\.gz)?$", "", os.path.basename(file))
+    state = os.path.join("State", name)
+    data = pd.read_csv(file)
+    fingerprints = {"raw": raw_fingerprints(pattern), "output": output_fingerprints(data)}
+    partitions = []
+    if os.path.exists(os.path.join(state, "fingerprints.json")):
+        with open(os.path.join(state, "fingerprints.json")) as f:
+            previous_fingerprints = json.load(f)
+        raw = changed(fingerprints["raw"], previous_fingerprints["raw"])
+        partitions = changed(fingerprints["output"], previous_fingerprints["output"])
+        print("{}: {} raw partitions and {} output partitions changed".format(name, len(raw), len(partitions)))
+        for partition in raw: # A year's raw partition covers each of that year's subjects
+            unchanged = not any(p == partition or p.startswith(partition + "|") for p in partitions)
+            print("    {}{}".format(partition, " (output unchanged)" if unchanged else ""))
+    else:
+        print("{}: no previous run, recording state".format(name))
+        if not os.path.exists(state):
+            os.makedirs(state)
+    if partitions:
+        changes = compare_rows(in_partitions(pd.read_csv(os.path.join(state, "previous.csv.gz")), partitions), in_partitions(data, partitions))
+    else:
+        changes = compare_rows(data.iloc[:0], data.iloc[:0])
+    changes.to_csv(os.path.join(os.path.dirname(file), name + " changes.csv"), index=False) # Always written so that an earlier run's changes are never applied twice
+    data.to_csv(os.path.join(state, "previous.csv.gz"), index=False)
+    with open(os.path.join(state, "fingerprints.json"), "w") as f:
+        json.dump(fingerprints, f, indent=2)
+
+def main(datasets):
+    for file, pattern in datasets:
+        if not os.path.exists(file) and os.path.exists(file + ".gz"): # Outputs saved compressed
+            file += ".gz"
+        if os.path.exists(file):
+            find_changes(file, pattern)
+
+if __name__ == "__main__":
+    main(datasets)
@@ -0,0 +1,129 @@
+import collections
+import numpy as np
+import pandas as pd
+
+"""
+Year-on-year analysis of ranks in the combined table created by combine_tables.py.
+Ranks are held in a single array with one row per series (publisher, table, subject, metric & UKPRN) and one column per year, so that:
+    • Movement between any two years (and so risers and fallers) is a single subtraction
+    • Rolling average ranks use cumulative sums along the year axis
+    • Volatility is the standard deviation of each series' year-on-year movement
+    • Percentiles compare each rank with the other institutions in the same publisher, table, subject & metric
+The array is saved as 'League Tables Series.npz' so that dashboards can load it without re-reading the combined table, e.g.:
+    series = load_series("League Tables Series.npz")
+    risers, fallers = risers_fallers(series, 2020, mask=select(series, publisher="Guardian", table="Institutional"))
+Where more than one institution shares a UKPRN (following mergers) the best rank is used.
+"""
+
+key_columns = ["Publisher", "Table", "Subject", "Metric", "UKPRN"]
+
+Series = collections.namedtuple("Series", ["keys", "group", "years", "ranks"]) # Row i of ranks is the series in row i of keys, column j is years[j]
+
+def build_series(data):
+    """
+    Arrange the ranks of the combined table as a (series × year) array
+    """
+    data = data.loc[data["Rank"].notnull(), key_columns + ["Year", "Rank"]].copy()
+    data["Subject"] = data["Subject"].astype(object).fillna("") # Institutional tables have no subject
+    best = data.groupby(key_columns + ["Year"], observed=True)["Rank"].min().reset_index()
+    rows = best.groupby(key_columns, observed=True, sort=False).ngroup().values # Numbered in order of first appearance
+    keys = best[key_columns].drop_duplicates().reset_index(drop=True)
+    group = keys.groupby(key_columns[:-1], observed=True, sort=False).ngroup().values
+    years = np.arange(best["Year"].min(), best["Year"].max() + 1)
+    ranks = np.full((len(keys), len(years)), np.nan, dtype="float32")
+    ranks[rows, best["Year"].values - years[0]] = best["Rank"].values
+    return Series(keys, group, years, ranks)
+
+def save_series(series, file):
+    arrays = {c: np.asarray(series.keys[c]).astype(str) for c in key_columns[:-1]}
+    np.savez(file, UKPRN=series.keys["UKPRN"].values, group=series.group, years=series.years, ranks=series.ranks, **arrays)
+
+def load_series(file):
+    with np.load(file) as f:
+        keys = pd.DataFrame({c: f[c] for c in key_columns})
+        keys = keys.astype({c: "category" for c in key_columns[:-1]})
+        return Series(keys, f["group"], f["years"], f["ranks"])
+
+def year_column(series, year):
+    if year not in series.years:
+        raise ValueError("{} is not in the years {} to {}".format(year, series.years[0], series.years[-1]))
+    return int(year - series.years[0])
+
+def select(series, publisher=None, table=None, subject=None, metric=None, ukprns=None):
+    """
+    Boolean mask of the series matching all of the given filters
+    """
+    mask = np.ones(len(series.keys), dtype=bool)
+    for column, value in [("Publisher", publisher), ("Table", table), ("Subject", subject), ("Metric", metric)]:
+        if value is not None:
+            mask &= (series.keys[column] == value).values
+    if ukprns is not None:
+        mask &= series.keys["UKPRN"].isin(ukprns).values
+    return mask
+
+def movement(series, year, previous=None, mask=None):
+    """
+    Places moved between the previous (or a given) year and a year, positive for a rise
+    """
+    before = series.ranks[:, year_column(series, year - 1 if previous is None else previous)]
+    after = series.ranks[:, year_column(series, year)]
+    data = series.keys.assign(**{"Previous Rank": before, "Rank": after, "Movement": before - after})
+    if mask is not None:
+        data = data.loc[mask]
+    return data.loc[data["Movement"].notnull()]
+
+def risers_fallers(series, year, n=10, previous=None, mask=None):
+    """
+    The n series with the largest rises and falls in rank
+    """
+    data = movement(series, year, previous, mask)
+    return data.nlargest(n, "Movement"), data.nsmallest(n, "Movement")
+
+def rolling_average(series, window=3, min_periods=None):
+    """
+    Mean rank over each year and the previous (window - 1) years, where at least min_periods (default window) ranks are available
+    """
+    min_periods = window if min_periods is None else min_periods
+    present = ~np.isnan(series.ranks)
+    sums = np.zeros((len(series.ranks), len(series.years) + 1))
+    counts = np.zeros((len(series.ranks), len(series.years) + 1), dtype=int)
+    sums[:, 1:] = np.cumsum(np.where(present, series.ranks, 0), axis=1)
+    counts[:, 1:] = np.cumsum(present, axis=1)
+    end = np.arange(1, len(series.years) + 1)
+    start = np.maximum(end - window, 0)
+    window_sums, window_counts = sums[:, end] - sums[:, start], counts[:, end] - counts[:, start]
+    averages = np.full(window_sums.shape, np.nan)
+    enough = window_counts >= max(min_periods, 1)
+    averages[enough] = window_sums[enough] / window_counts[enough]
+    return pd.concat([series.keys, pd.DataFrame(averages, columns=series.years)], axis=1)
+
+def volatility(series, mask=None):
+    """
+    Standard deviation of year-on-year movement for each series with at least two movements
+    (e.g. volatility(series).groupby(["Publisher", "Table", "Metric"], observed=True)["Volatility"].median() gives volatility per metric)
+    """
+    moves = series.ranks[:, :-1].astype("float64") - series.ranks[:, 1:]
+    counts = (~np.isnan(moves)).sum(axis=1)
+    means = np.nansum(moves, axis=1) / np.maximum(counts, 1)
+    squares = np.nansum((moves - means[:, None]) ** 2, axis=1)
+    deviations = np.where(counts > 1, np.sqrt(squares / np.maximum(counts - 1, 1)), np.nan)
+    data = series.keys.assign(**{"Movements": counts, "Volatility": deviations})
+    if mask is not None:
+        data = data.loc[mask]
+    return data.loc[data["Volatility"].notnull()]
+
+def percentiles(series, year, mask=None):
+    """
+    Percentile of each rank in a year among the institutions in the same publisher, table, subject & metric (100 is top)
+    """
+    ranks = pd.Series(series.ranks[:, year_column(series, year)])
+    data = series.keys.assign(**{"Rank": ranks.values, "Percentile": ranks.groupby(series.group).rank(ascending=False, pct=True).values * 100})
+    if mask is not None:
+        data = data.loc[mask]
+    return data.loc[data["Rank"].notnull()]
+
+if __name__ == "__main__":
+    data = pd.read_parquet("League Tables Combined.parquet")
+    series = build_series(data)
+    save_series(series, "League Tables Series.npz") # Save ranks array to disk
+    print("Saved {} series over {} years".format(len(series.keys), len(series.years)))
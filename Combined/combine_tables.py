@@ -0,0 +1,67 @@
+import os
+import pandas as pd
+
+"""
+Each publisher's output uses a different set of columns (e.g. 'Location' and 'Region' for the international tables, 'Subject Code' for Guardian subjects).
+This script merges the UKPRN-enriched outputs of lt_name_ukprn.py into a single typed, deduplicated long table so that comparisons across publishers are a single scan.
+Rows without a UKPRN (i.e. non-UK institutions in the international tables) are dropped, as UKPRN is the key used across publishers.
+The table is saved once in columnar form as 'League Tables Combined.parquet' (requires pyarrow or fastparquet).
+"""
+
+files = [
+    ("Complete University Guide", "Institutional", os.path.join("..", "Complete University Guide", "Institutional", "Complete University Guide Institutional with UKPRN.csv")),
+    ("Complete University Guide", "Subjects", os.path.join("..", "Complete University Guide", "Subjects", "Complete University Guide Subjects with UKPRN.csv")),
+    ("Guardian", "Institutional", os.path.join("..", "Guardian", "Guardian Institutional with UKPRN.csv")),
+    ("Guardian", "Subjects", os.path.join("..", "Guardian", "Guardian Subjects with UKPRN.csv")),
+    ("Times and Sunday Times", "Institutional", os.path.join("..", "Times and Sunday Times", "Institutional", "Times & Sunday Times Institutional with UKPRN.csv")),
+    ("Times and Sunday Times", "Subjects", os.path.join("..", "Times and Sunday Times", "Subjects", "Times & Sunday Times Subject with UKPRN.csv")),
+    ("QS", "Institutional", os.path.join("..", "QS", "World University Rankings", "Institutional", "QS WUR Institutional with UKPRN.csv")),
+    ("QS", "Subjects", os.path.join("..", "QS", "World University Rankings", "Subjects", "QS WUR Subjects with UKPRN.csv")),
+    ("Times Higher Education", "Institutional", os.path.join("..", "Times Higher Education", "World University Rankings", "Institutional", "THE WUR Institutional with UKPRN.csv")),
+    ("Times Higher Education", "Subjects", os.path.join("..", "Times Higher Education", "World University Rankings", "Subjects", "THE WUR Subjects with UKPRN.csv"))
+]
+
+columns = ["Publisher", "Table", "Year", "Subject", "Metric", "UKPRN", "Value", "Numeric Value", "Rank", "Decile"]
+
+def read_table(publisher, table, file):
+    """
+    Load only the shared columns of one output and label it with its publisher and table
+    """
+    data = pd.read_csv(file, usecols=lambda c: c in columns, dtype={"Value": str})
+    data = data.loc[data["UKPRN"].notnull()]
+    data["Publisher"] = publisher
+    data["Table"] = table
+    if "Subject" not in data.columns:
+        data["Subject"] = None # Institutional tables have no subject
+    data["Rank"] = pd.to_numeric(data["Rank"], errors="coerce") # Official ranks of banded international tables may be stored as text
+    return data[columns]
+
+def combine_tables(files):
+    """
+    Concatenate every available output, set compact types and remove duplicate rows
+    """
+    data = []
+    for publisher, table, file in files:
+        if not os.path.exists(file) and os.path.exists(file + ".gz"): # Outputs saved compressed
+            file += ".gz"
+        if os.path.exists(file):
+            data.append(read_table(publisher, table, file))
+        else:
+            print("Skipping missing file", file)
+    data = pd.concat(data, axis=0, ignore_index=True)
+    data.drop_duplicates(inplace=True) # Keep distinct rows which share a UKPRN following mergers
+    data = data.astype({
+        "Publisher": "category",
+        "Table": "category",
+        "Year": "int16",
+        "Subject": "category",
+        "Metric": "category",
+        "UKPRN": "int32",
+        "Rank": "float32",
+        "Decile": "float32"
+    })
+    return data.reset_index(drop=True)
+
+if __name__ == "__main__":
+    data = combine_tables(files)
+    data.to_parquet("League Tables Combined.parquet", index=False) # Save final table to disk
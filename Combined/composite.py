@@ -0,0 +1,94 @@
+import hashlib
+import argparse
+import pandas as pd
+
+"""
+Composite 'table of tables' from the combined table created by combine_tables.py.
+Each publisher's overall institutional score (or rank) is normalised within each publisher and year, then averaged with configurable weights:
+    • 'z' normalisation uses the z-score, 'percentile' uses the percentile rank (higher is better for both)
+    • Scores are taken from the 'Numeric Value' field, or with --on rank from the 'Rank' field (useful where international scores are banded or blank)
+    • Only UK institutions with a UKPRN are included, so international tables are normalised among UK institutions
+Normalised scores are cached by a fingerprint of the combined table, so re-weighting only repeats the weighted average, e.g.:
+    scores = load_scores("League Tables Combined.parquet")
+    ranks = composite_ranks(scores, {"Guardian": 2, "QS": 0}) # Publishers not given a weight count once
+Saved as 'League Tables Composite.csv' when run as a script.
+"""
+
+overall_metrics = {
+    "Complete University Guide": "Overall Score",
+    "Guardian": "Average Teaching Score",
+    "Times and Sunday Times": "Total",
+    "Times Higher Education": "Overall",
+    "QS": "OVERALL SCORE"
+}
+
+cache = {}
+
+def fingerprint(file):
+    with open(file, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def normalise(data, method="z", on="score"):
+    """
+    Normalise each publisher's overall score within each year, returning one column per publisher for each UKPRN & year
+    """
+    data = data.loc[(data["Table"] == "Institutional") & (data["Metric"].astype(str) == data["Publisher"].astype(str).map(overall_metrics))]
+    data = data.assign(Score=data["Numeric Value"] if on == "score" else -data["Rank"]) # Negate ranks so that higher is better
+    data = data.groupby(["Publisher", "Year", "UKPRN"], observed=True)["Score"].max().reset_index() # Best score where institutions share a UKPRN
+    groups = data.groupby(["Publisher", "Year"], observed=True)["Score"]
+    if method == "z":
+        data["Score"] = (data["Score"] - groups.transform("mean")) / groups.transform("std")
+    elif method == "percentile":
+        data["Score"] = groups.rank(pct=True) * 100
+    else:
+        raise ValueError("Unknown normalisation method {}".format(method))
+    scores = data.pivot_table(index=["UKPRN", "Year"], columns="Publisher", values="Score", observed=True)
+    scores.columns = scores.columns.astype(str)
+    return scores
+
+def load_scores(file, method="z", on="score"):
+    """
+    Normalised scores for a combined table, cached by the table's fingerprint
+    """
+    key = (fingerprint(file), method, on)
+    if key not in cache:
+        cache[key] = normalise(pd.read_parquet(file, columns=["Publisher", "Table", "Year", "Metric", "UKPRN", "Numeric Value", "Rank"]), method, on)
+    return cache[key]
+
+def composite_ranks(scores, weights=None, min_tables=1):
+    """
+    Weighted mean of the normalised scores available for each institution & year, ranked within each year (weights must be for publishers in overall_metrics & not negative)
+    """
+    weights = pd.Series(weights or {}, dtype=float)
+    unknown = [p for p in weights.index if p not in overall_metrics]
+    if unknown:
+        raise ValueError("Unknown publishers {} (expected one of {})".format(", ".join(unknown), ", ".join(overall_metrics)))
+    if (weights < 0).any():
+        raise ValueError("Weights can't be negative: {}".format(", ".join("{}={:g}".format(p, w) for p, w in weights[weights < 0].items())))
+    weights = weights.reindex(scores.columns).fillna(1) # Publishers without a weight count once, a weight of 0 excludes them
+    present = scores.notnull() & (weights > 0)
+    totals = (scores.fillna(0) * weights).sum(axis=1)
+    data = scores.copy()
+    data["Tables"] = present.sum(axis=1)
+    data["Composite Score"] = (totals / present.mul(weights).sum(axis=1)).where(data["Tables"] >= min_tables)
+    data = data.loc[data["Composite Score"].notnull()]
+    data["Composite Rank"] = data.groupby(level="Year")["Composite Score"].rank(ascending=False, method="min")
+    return data.reset_index().sort_values(["Year", "Composite Rank"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank institutions on a weighted composite of publishers' overall scores")
+    parser.add_argument("--method", choices=["z", "percentile"], default="z", help="Normalisation within each publisher & year")
+    parser.add_argument("--on", choices=["score", "rank"], default="score", help="Normalise overall scores or ranks")
+    parser.add_argument("--weight", action="append", default=[], metavar="PUBLISHER=WEIGHT", help="Weight for a publisher, e.g. Guardian=2 (default 1 each)")
+    parser.add_argument("--min-tables", type=int, default=1, help="Minimum number of publishers ranking an institution")
+    args = parser.parse_args()
+    weights = {}
+    for weight in args.weight:
+        publisher, value = weight.rsplit("=", 1)
+        weights[publisher] = float(value)
+    scores = load_scores("League Tables Combined.parquet", args.method, args.on)
+    data = composite_ranks(scores, weights, args.min_tables)
+    data.to_csv("League Tables Composite.csv", index=False) # Save final CSV to disk
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
+import os
+import re
+import collections
 import requests
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 
+base_url = os.environ.get("CUG_URL", "https://www.thecompleteuniversityguide.co.uk") # Publisher's site, set CUG_URL to use another (e.g. the mock server)
+numeric_spec = re.compile(r"[,a-z]") # Characters stripped from CUG values before conversion to numbers (so "n/a" becomes NaN)
+
+id_columns = ["University Name"]
+metrics = ["Entry Standards", "Student Satisfaction", "Research Quality", "Graduate Prospects", "Student-Staff Ratio", "Academic Services Spend", "Facilities Spend", "Good Honours", "Degree Completion", "Overall Score", "Research Intensity"]
+ignored_spec = re.compile(r"Rank( \d+)?$") # Columns which are expected but dropped
+
 def get_cols(table):
     header = table.find_all("th")
     cols = []
@@ -16,14 +27,40 @@ def get_cols(table):
                 cols.append("{} {}".format(col.strip(), c))
     return cols
 
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
 def get_data(years):
-    url = "https://www.thecompleteuniversityguide.co.uk/league-tables/rankings?v=wide&y="
+    url = base_url + "/league-tables/rankings?v=wide&y="
     data = []
     for year in years:
         r = requests.get(url + str(year))
         soup = BeautifulSoup(r.text, "lxml")
         table = soup.find("table", {"class": "league-table-table"})
         table_cols = get_cols(table)
+        compare_schema({(year, None): table_cols}) # Check each year's headers as soon as the page is fetched, before melting
         table_data = []
         for row in table.find_all("tr"):
             table_row = []
@@ -35,20 +72,27 @@ def get_data(years):
         table_data = pd.melt(table_data, id_vars=["University Name"], var_name="Metric", value_name="Value")
         table_data["Year"] = year
         data.append(table_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
+
+def numeric_values(values):
+    """
+    Convert values to numbers by parsing each unique value once, also returning the values which couldn't be converted
+    """
+    codes, uniques = pd.factorize(values)
+    numbers = pd.to_numeric([numeric_spec.sub("", str(value)) for value in uniques], errors="coerce") # Coerce will turn blanks to NaNs
+    coerced = [str(value) for value, number in zip(uniques, numbers) if np.isnan(number)]
+    numbers = np.append(numbers, np.nan) # Missing values have a code of -1 so pick up the trailing NaN
+    return pd.Series(numbers[codes], index=values.index), coerced
 
 def clean_data(data):
     """
     Remove unnecessary metrics, add numerical values
     """
     data.rename(columns={"University Name": "Institution"}, inplace=True)
-    metrics = ["Entry Standards", "Student Satisfaction", "Research Quality", "Graduate Prospects", "Student-Staff Ratio", "Academic Services Spend", "Facilities Spend", "Good Honours", "Degree Completion", "Overall Score", "Research Intensity"]
     data = data.copy().loc[data["Metric"].isin(metrics)]
-    data["Numeric Value"] = data["Value"].astype(str)
-    data["Numeric Value"] = data["Numeric Value"].replace("n/a", "", regex=False)
-    data["Numeric Value"] = data["Numeric Value"].str.replace(",", "", regex=False)
-    data["Numeric Value"] = data["Numeric Value"].str.replace(r"[a-z]", "", regex=True)
-    data["Numeric Value"] = pd.to_numeric(data["Numeric Value"], errors="coerce") # Coerce will turn blanks to NaNs
+    data["Numeric Value"], coerced = numeric_values(data["Value"])
+    if coerced:
+        print("Values converted to NaN:", ", ".join(sorted(coerced)))
     return data
 
 def rank_metrics(data):
@@ -67,8 +111,33 @@ def rank_metrics(data):
     )
     return data_exc_ssr.append(data_inc_ssr)
 
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "Complete University Guide Institutional.csv" # Add .gz to the filename to save compressed
+columns = ["Institution", "Metric", "Value", "Year", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
+
 years = [2009, 2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
-data = get_data(years)
-data = clean_data(data)
-data = rank_metrics(data)
-data.to_csv("Complete University Guide Institutional.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = get_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
@@ -1,6 +1,75 @@
 import os
+import re
+import collections
 import pandas as pd
 
+id_columns = ["Institution"]
+column_names = {"Name of Provider": "Institution"}
+metrics = [
+    "Average Teaching Score",
+    "NSS Teaching (%)",
+    "NSS Overall (%)",
+    "Continuation",
+    "Expenditure per student / 10",
+    "Student:staff ratio",
+    "Career prospects (%)",
+    "Value added score/10",
+    "Entry Tariff",
+    "NSS Feedback (%)"
+]
+metric_names = {
+    "satisfied with teaching (%)": "NSS Teaching (%)",
+    "% Satisfied with Teaching": "NSS Teaching (%)",
+    "satisfied with course (%)": "NSS Overall (%)",
+    "% Satisfied with course": "NSS Overall (%)",
+    "Expenditure per student (fte)": "Expenditure per student / 10",
+    "Student: staff ratio": "Student:staff ratio",
+    "Career prospects": "Career prospects (%)",
+    "Average Entry Tariff": "Entry Tariff",
+    "% Satisfied with Assessment": "NSS Feedback (%)",
+    "satisfied with feedback (%)": "NSS Feedback (%)"
+}
+ignored_spec = re.compile(r"(?i).*rank|unnamed|hesa|uni group|recenthistory|\d{4}$") # Columns which are expected but dropped (previous ranks, codes etc.)
+
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each year's headers against the expected columns (after renaming) before reading whole sheets
+    """
+    lookup = pd.read_csv("lookup.csv", index_col=0)
+    headers = {}
+    for year in years:
+        filename = lookup.loc["Filename", str(year)]
+        sheet_name = lookup.loc["Institutional", str(year)]
+        header = int(lookup.loc["Institutional Header", str(year)])
+        columns = pd.read_excel(os.path.join("Originals", filename), sheet_name=sheet_name, header=header, nrows=0).rename(columns=column_names).columns
+        headers[(year, None)] = [metric_names.get(c, c) for c in columns]
+    compare_schema(headers)
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' and concatenate into one DataFrame
@@ -12,41 +81,19 @@ def concat_data(years):
         sheet_name = lookup.loc["Institutional", str(year)]
         header = int(lookup.loc["Institutional Header", str(year)])
         csv_data = pd.read_excel(os.path.join("Originals", filename), sheet_name=sheet_name, header=header)
-        csv_data.rename(columns={"Name of Provider": "Institution"}, inplace=True)
+        csv_data.rename(columns=column_names, inplace=True)
         csv_data = pd.melt(csv_data, id_vars=["Institution"], var_name="Metric", value_name="Value")
         csv_data["Year"] = year
         data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
 
 def clean_data(data):
     """
     Make metric names consistent, remove unecessary fields, ensure numerical values
     """
     data.dropna(subset=["Institution"], inplace=True)
-    data["Metric"].replace({
-        "satisfied with teaching (%)": "NSS Teaching (%)",
-        "% Satisfied with Teaching": "NSS Teaching (%)",
-        "satisfied with course (%)": "NSS Overall (%)",
-        "% Satisfied with course": "NSS Overall (%)",
-        "Expenditure per student (fte)": "Expenditure per student / 10",
-        "Student: staff ratio": "Student:staff ratio",
-        "Career prospects": "Career prospects (%)",
-        "Average Entry Tariff": "Entry Tariff",
-        "% Satisfied with Assessment": "NSS Feedback (%)",
-        "satisfied with feedback (%)": "NSS Feedback (%)"
-    }, inplace=True)
-    data = data.copy().loc[data["Metric"].isin([
-        "Average Teaching Score",
-        "NSS Teaching (%)",
-        "NSS Overall (%)",
-        "Continuation",
-        "Expenditure per student / 10",
-        "Student:staff ratio",
-        "Career prospects (%)",
-        "Value added score/10",
-        "Entry Tariff",
-        "NSS Feedback (%)"
-    ])]
+    data["Metric"].replace(metric_names, inplace=True)
+    data = data.copy().loc[data["Metric"].isin(metrics)]
     data["Numeric Value"] = pd.to_numeric(data["Value"], errors="coerce") # Coerce will turn blanks to NaNs
     return data
 
@@ -66,8 +113,34 @@ def rank_metrics(data):
     )
     return data_exc_ssr.append(data_inc_ssr)
 
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "Guardian Institutional.csv" # Add .gz to the filename to save compressed
+columns = ["Institution", "Metric", "Value", "Year", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
+
 years = [2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
-data = concat_data(years)
-data = clean_data(data)
-data = rank_metrics(data)
-data.to_csv("Guardian Institutional.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
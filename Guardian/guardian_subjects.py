@@ -1,7 +1,75 @@
 import os
+import collections
 import pandas as pd
 import re
 
+id_columns = ["Institution"]
+column_names = {
+    "Name of Institution": "Institution",
+    "Name of Provider": "Institution"
+}
+metrics = [
+    "Guardian score/100",
+    "% Satisfied with Teaching",
+    "% Satisfied with course",
+    "Continuation",
+    "Expenditure per student (FTE)",
+    "Student:staff ratio",
+    "Career prospects",
+    "Value added score/10",
+    "Average Entry Tariff",
+    "% Satisfied with Assessment"
+]
+metric_names = {
+    "Student: staff ratio": "Student:staff ratio",
+    "Continuation ": "Continuation",
+    "% Satisfied overall with course": "% Satisfied with course",
+    "Guardian Score/100": "Guardian score/100",
+    "Expenditure per student (fte)": "Expenditure per student (FTE)"
+}
+ignored_spec = re.compile(r"(?i)rank$|tariff bands|subject description|profile links") # Columns which are expected but dropped
+
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each subject's headers against the expected columns (after renaming) before reading whole sheets
+    """
+    lookup = pd.read_csv("lookup.csv", index_col=0)
+    subjects = [s for s in lookup.index.values if re.match("S\d", s)] + ["Human Geo"]
+    headers = {}
+    for year in years:
+        workbook = pd.ExcelFile(os.path.join("Originals", lookup.loc["Filename", str(year)]))
+        for subject in subjects:
+            sheet_name = lookup.loc[subject, str(year)]
+            if type(sheet_name) == str:
+                columns = workbook.parse(sheet_name=sheet_name, header=1, nrows=0).rename(columns=column_names).columns
+                headers[(year, subject)] = [metric_names.get(c, c) for c in columns]
+    compare_schema(headers)
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' & 'Subject' and concatenate into one DataFrame
@@ -16,39 +84,21 @@ def concat_data(years):
             sheet_name = lookup.loc[subject, str(year)]
             if type(sheet_name) == str:
                 csv_data = pd.read_excel(os.path.join("Originals", filename), sheet_name=sheet_name, header=1)
-                csv_data.rename(columns={
-                    "Name of Institution": "Institution",
-                    "Name of Provider": "Institution"
-                }, inplace=True)
+                csv_data.rename(columns=column_names, inplace=True)
                 csv_data = pd.melt(csv_data, id_vars=["Institution"], var_name="Metric", value_name="Value")
                 csv_data["Year"] = year
                 csv_data["Subject Code"] = subject[0:4]
                 csv_data["Subject"] = subject[5:]
                 data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
 
 def clean_data(data):
     """
     Make metric names consistent, remove unecessary fields, ensure numerical values
     """
     data.dropna(subset=["Value"], inplace=True)
-    data["Metric"].replace({
-        "Student: staff ratio": "Student:staff ratio",
-        "Continuation ": "Continuation",
-        "% Satisfied overall with course": "% Satisfied with course"
-    }, inplace=True)
-    data = data.copy().loc[data["Metric"].isin([
-        "Guardian score/100",
-        "% Satisfied with Teaching",
-        "% Satisfied with course",
-        "Continuation",
-        "Expenditure per student (FTE)",
-        "Student:staff ratio",
-        "Career prospects",
-        "Value added score/10",
-        "Average Entry Tariff",
-        "% Satisfied with Assessment"
-    ])]
+    data["Metric"].replace(metric_names, inplace=True)
+    data = data.copy().loc[data["Metric"].isin(metrics)]
     data["Numeric Value"] = pd.to_numeric(data["Value"], errors="coerce") # Coerce will turn blanks to NaNs
     return data
 
@@ -68,8 +118,34 @@ def rank_metrics(data):
     )
     return data_exc_ssr.append(data_inc_ssr)
 
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "Guardian Subjects.csv" # Add .gz to the filename to save compressed
+columns = ["Institution", "Metric", "Value", "Year", "Subject Code", "Subject", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
+
 years = [2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
-data = concat_data(years)
-data = clean_data(data)
-data = rank_metrics(data)
-data.to_csv("Guardian Subjects.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+import resource
+import argparse
+import platform
+import functools
+import importlib.util
+import requests
+import pandas as pd
+
+"""
+Run any of the league table scripts with each stage instrumented, e.g.:
+    python3 instrument.py "../QS/World University Rankings/Subjects/qs_subjects.py" --profile cprofile
+Each call of a stage (fetch_json, get_data, json_to_csv, check_schema, concat_data, clean_data, rank_metrics and the UKPRN stages) records:
+    • Wall time, CPU time and the peak RSS during the stage (on Linux the peak is reset as each stage starts, elsewhere tracemalloc's peak is recorded instead)
+    • Rows in (DataFrame arguments) and rows out (DataFrame result)
+    • The number of HTTP requests made and bytes received
+A JSON run manifest is saved alongside the script (or to --manifest) and, optionally, a cProfile or pyinstrument profile per stage in a 'Profiles' folder.
+Passing an earlier manifest as --baseline reports any stage slower by more than --tolerance and exits with status 1, so nightly builds can alert on regressions.
+"""
+
+stages = ["fetch_json", "get_data", "json_to_csv", "check_schema", "concat_data", "clean_data", "rank_metrics", "gen_names", "find_ukprn", "add_ukprn", "add_group_ranks"]
+
+http = {"requests": 0, "bytes": 0}
+peaks = [] # Highest reading so far of each stage that's running, innermost last
+run_peak = {"mb": 0, "method": "rss"}
+
+def count_http(send):
+    """
+    Wrap requests' Session.send to count every request and the bytes received
+    """
+    @functools.wraps(send)
+    def wrapper(session, request, **kwargs):
+        response = send(session, request, **kwargs)
+        http["requests"] += 1
+        http["bytes"] += len(response.content)
+        return response
+    return wrapper
+
+def clear_peak():
+    """
+    Reset the peak RSS of the process (Linux only), returning False if it can't be reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    """
+    Peak resident set size of the process in MB since it was last reset (VmHWM on Linux), or tracemalloc's peak if tracing
+    """
+    if tracemalloc.is_tracing():
+        peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    elif os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) / 1024
+    else:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / 1024 ** 2 if sys.platform == "darwin" else maxrss / 1024 # ru_maxrss is in kB on Linux but bytes on macOS
+    run_peak["mb"] = max(run_peak["mb"], peak)
+    return peak
+
+def start_peak():
+    """
+    Fold the current peak into the enclosing stage (if any) and reset it for a new stage
+    """
+    if peaks:
+        peaks[-1] = max(peaks[-1], peak_rss())
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    elif not clear_peak():
+        tracemalloc.start() # No way to reset the RSS peak, so trace Python's allocations instead
+        run_peak["method"] = "tracemalloc"
+    peaks.append(0)
+
+def end_peak():
+    """
+    Peak during the stage just finished, which also counts towards the enclosing stage's peak
+    """
+    peak = max(peaks.pop(), peak_rss())
+    if peaks:
+        peaks[-1] = max(peaks[-1], peak)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak() # The enclosing stage has already recorded its earlier peak
+    return peak
+
+def count_rows(values):
+    frames = [v for v in values if isinstance(v, pd.DataFrame)]
+    return sum(len(f) for f in frames) if frames else None
+
+def start_profile(profile):
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if profile == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+
+def save_profile(profile, profiler, name):
+    if not os.path.exists("Profiles"):
+        os.makedirs("Profiles")
+    if profile == "cprofile":
+        profiler.disable()
+        profiler.dump_stats(os.path.join("Profiles", "{}.prof".format(name)))
+    elif profile == "pyinstrument":
+        profiler.stop()
+        with open(os.path.join("Profiles", "{}.html".format(name)), "w") as f:
+            f.write(profiler.output_html())
+
+def instrument(func, records, profile):
+    """
+    Wrap a stage so that each call appends a record of its resource use
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        requests_before, bytes_before = http["requests"], http["bytes"]
+        profiler = start_profile(profile)
+        start_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            peak = end_peak()
+        if profiler:
+            save_profile(profile, profiler, "{}_{}".format(len(records) + 1, func.__name__))
+        records.append({
+            "stage": func.__name__,
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(cpu, 3),
+            "peak_rss_mb": round(peak, 1),
+            "rows_in": count_rows(list(args) + list(kwargs.values())),
+            "rows_out": count_rows(result if isinstance(result, tuple) else [result]),
+            "http_requests": http["requests"] - requests_before,
+            "http_bytes": http["bytes"] - bytes_before
+        })
+        return result
+    return wrapper
+
+def load_script(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run(path, profile=None):
+    """
+    Run a script's main() from its own folder with its stages instrumented, returning the run manifest
+    """
+    path = os.path.abspath(path)
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    records = []
+    send = requests.Session.send
+    requests.Session.send = count_http(send)
+    started = time.time()
+    try:
+        module = load_script(path)
+        for stage in stages:
+            if hasattr(module, stage):
+                setattr(module, stage, instrument(getattr(module, stage), records, profile))
+        if hasattr(module, "years"):
+            module.main(module.years)
+        else:
+            module.main(module.uk_files, module.int_files)
+    finally:
+        requests.Session.send = send
+        os.chdir(cwd)
+        tracemalloc.stop()
+    return {
+        "script": os.path.relpath(path, cwd),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "wall_seconds": round(time.time() - started, 3),
+        "peak_rss_mb": round(run_peak["mb"], 1), # Highest of the readings, as resetting each stage's peak also resets the process's
+        "peak_memory": run_peak["method"],
+        "http_requests": http["requests"],
+        "http_bytes": http["bytes"],
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "stages": records
+    }
+
+def compare(manifest, baseline, tolerance):
+    """
+    List the stages which took longer than in the baseline manifest by more than the tolerance
+    """
+    previous = {}
+    for record in baseline["stages"]:
+        previous[record["stage"]] = previous.get(record["stage"], 0) + record["wall_seconds"]
+    current = {}
+    for record in manifest["stages"]:
+        current[record["stage"]] = current.get(record["stage"], 0) + record["wall_seconds"]
+    return [(stage, previous[stage], seconds) for stage, seconds in current.items() if previous.get(stage) and seconds > previous[stage] * (1 + tolerance)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a league table script with per-stage instrumentation")
+    parser.add_argument("script", help="Path to the script to run")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"], help="Save a profile of each stage")
+    parser.add_argument("--manifest", help="Where to save the run manifest (default alongside the script)")
+    parser.add_argument("--baseline", help="Compare with an earlier run manifest")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fractional slowdown against the baseline to report")
+    args = parser.parse_args()
+    manifest = run(args.script, args.profile)
+    path = args.manifest or os.path.splitext(args.script)[0] + " manifest.json"
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(pd.DataFrame(manifest["stages"]).astype({"rows_in": "Int64", "rows_out": "Int64"}).to_string(index=False))
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(manifest, json.load(f), args.tolerance)
+        for stage, previous, seconds in slower:
+            print("{} took {:.3f}s against {:.3f}s in the baseline".format(stage, seconds, previous))
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
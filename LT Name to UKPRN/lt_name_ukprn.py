@@ -39,12 +39,27 @@ int_files = [
     os.path.join("..", "Times Higher Education", "World University Rankings", "Subjects", "THE WUR Subjects.csv")
 ]
 
+chunk_size = 100000 # Rows read at a time by add_ukprn() and add_group_ranks()
+
+def find_file(file):
+    """
+    A dataset's CSV file, or its gzipped copy if the dataset was saved compressed
+    """
+    return file + ".gz" if not os.path.exists(file) and os.path.exists(file + ".gz") else file
+
+def derived_file(file, suffix):
+    """
+    Name of a file derived from a dataset, e.g. 'X with UKPRN.csv' from 'X.csv' (or 'X with UKPRN.csv.gz' from 'X.csv.gz')
+    """
+    name, extension = (file[:-7], file[-7:]) if file.endswith(".csv.gz") else os.path.splitext(file)
+    return name + suffix + extension
+
 def gen_names(uk_files, int_files):
     names = []
     for file in uk_files:
-        names.append(pd.read_csv(file)["Institution"])
+        names.append(pd.read_csv(find_file(file))["Institution"])
     for file in int_files:
-        df = pd.read_csv(file)
+        df = pd.read_csv(find_file(file))
         names.append(df.loc[df["Location"] == "United Kingdom"]["Institution"])
     return pd.DataFrame(pd.concat(names).unique(), columns=["LT Name"])
 
@@ -83,15 +98,19 @@ def final_ukprn(row):
         return row["Manual UKPRN"]
 
 def add_ukprn(uk_files, int_files, names):
+    institutions = pd.read_csv("learning-providers-plus.csv")
+    institutions = institutions[["UKPRN", "VIEW_NAME"]]
+    institutions.rename(columns={"VIEW_NAME": "Consistent Name"}, inplace=True)
+    institutions["UKPRN"] = institutions["UKPRN"].astype("Int64")
     for file in uk_files + int_files:
-        data = pd.read_csv(file)
-        data = data.merge(names, how="left", left_on="Institution", right_on="LT Name")
-        data.drop(columns="LT Name", inplace=True)
-        institutions = pd.read_csv("learning-providers-plus.csv")
-        institutions = institutions[["UKPRN", "VIEW_NAME"]]
-        institutions.rename(columns={"VIEW_NAME": "Consistent Name"}, inplace=True)
-        data = data.merge(institutions, how="left", left_on="UKPRN", right_on="UKPRN")
-        data.to_csv(os.path.splitext(file)[0] + " with UKPRN.csv", index=False)
+        file = find_file(file)
+        chunks = pd.read_csv(file, dtype=str, chunksize=chunk_size) # Values are copied as text, a chunk at a time, so the whole dataset is never held in memory
+        for i, data in enumerate(chunks):
+            data = data.merge(names, how="left", left_on="Institution", right_on="LT Name")
+            data.drop(columns="LT Name", inplace=True)
+            data["UKPRN"] = data["UKPRN"].astype("Int64") # Nullable so that every chunk writes UKPRNs as integers, whether or not some are missing
+            data = data.merge(institutions, how="left", left_on="UKPRN", right_on="UKPRN")
+            data.to_csv(derived_file(file, " with UKPRN"), mode="w" if i == 0 else "a", header=i == 0, index=False)
 
 def add_group_ranks(uk_files, int_files):
     """
@@ -100,20 +119,28 @@ def add_group_ranks(uk_files, int_files):
     institutions = pd.read_csv("learning-providers-plus.csv")
     members = institutions.loc[institutions["GROUPS"].astype(str).str.contains("Russell_Group"), "UKPRN"].tolist()
     for file in uk_files + int_files:
-        file = os.path.splitext(file)[0] + " with UKPRN.csv"
-        data = pd.read_csv(file)
-        if "Subject" in data.columns:
-            data.loc[data["UKPRN"].isin(members), "RG Rank"] = data.loc[data["UKPRN"].isin(members)].groupby(["Year", "Subject", "Metric"])["Rank"].rank(ascending=True, method="min") # Rank on existing rank rather than value to avoid detecting SSR metrics etc.
-        else:
-            data.loc[data["UKPRN"].isin(members), "RG Rank"] = data.loc[data["UKPRN"].isin(members)].groupby(["Year", "Metric"])["Rank"].rank(ascending=True, method="min") # Rank on existing rank rather than value to avoid detecting SSR metrics etc.
-        data.to_csv(os.path.splitext(file)[0] + " & RG Rank.csv", index=False)
+        file = derived_file(find_file(file), " with UKPRN")
+        keys = ["Year", "Subject", "Metric"] if "Subject" in pd.read_csv(file, nrows=0).columns else ["Year", "Metric"]
+        data = pd.read_csv(file, usecols=keys + ["UKPRN", "Rank"]) # Only the fields needed for ranking are held in memory
+        data.loc[data["UKPRN"].isin(members), "RG Rank"] = data.loc[data["UKPRN"].isin(members)].groupby(keys)["Rank"].rank(ascending=True, method="min") # Rank on existing rank rather than value to avoid detecting SSR metrics etc.
+        ranks = data["RG Rank"].values
+        start = 0
+        for i, chunk in enumerate(pd.read_csv(file, dtype=str, chunksize=chunk_size)): # Then the other fields are copied across a chunk at a time
+            chunk["UKPRN"] = pd.to_numeric(chunk["UKPRN"]).astype("Int64") # Integers in every chunk, as in add_ukprn()
+            chunk["RG Rank"] = ranks[start:start + len(chunk)]
+            start += len(chunk)
+            chunk.to_csv(derived_file(file, " & RG Rank"), mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+def main(uk_files, int_files):
+    names = gen_names(uk_files, int_files)
+    names = find_ukprn(names)
+    names.to_csv("lt_names_ukprn_interim.csv", index=False)
+    names = pd.read_csv("lt_names_ukprn_interim_25-12-2019.csv", converters={"Matched UKPRNs": literal_eval})
+    names["UKPRN"] = names.apply(final_ukprn, axis=1)
+    names = names[["LT Name", "UKPRN"]]
+    names["UKPRN"] = names["UKPRN"].astype("int")
+    add_ukprn(uk_files, int_files, names)
+    add_group_ranks(uk_files, int_files)
 
-names = gen_names(uk_files, int_files)
-names = find_ukprn(names)
-names.to_csv("lt_names_ukprn_interim.csv", index=False)
-names = pd.read_csv("lt_names_ukprn_interim_25-12-2019.csv", converters={"Matched UKPRNs": literal_eval})
-names["UKPRN"] = names.apply(final_ukprn, axis=1)
-names = names[["LT Name", "UKPRN"]]
-names["UKPRN"] = names["UKPRN"].astype("int")
-add_ukprn(uk_files, int_files, names)
-add_group_ranks(uk_files, int_files)
+if __name__ == "__main__":
+    main(uk_files, int_files)
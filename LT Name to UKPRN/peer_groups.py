@@ -0,0 +1,65 @@
+import functools
+import collections
+import numpy as np
+import pandas as pd
+
+"""
+Rank institutions within any peer group on demand, without saving a new copy of the dataset as add_group_ranks() does.
+A peer group is either a label from the 'GROUPS' field of learning-providers-plus.csv (e.g. "Russell_Group", "N8_Research_Partnership") or any list of UKPRNs, e.g.:
+    ranked = prepare(pd.read_csv(os.path.join("..", "Guardian", "Guardian Subjects with UKPRN.csv")))
+    russell_group = peer_ranks(ranked, "Russell_Group")
+    competitors = peer_ranks(ranked, [10007774, 10007788, 10007785])
+    • prepare() numbers each (Year, Subject, Metric) group of the dataset once
+    • Membership of each peer group is held as a boolean mask over the dataset's rows, memoised per group
+    • 'Peer Rank' ranks on the existing rank (so lower is better for every metric) and 'Peer Decile' is 10 for the best tenth of the group
+"""
+
+Ranked = collections.namedtuple("Ranked", ["data", "groups", "masks"]) # masks is filled in as peer groups are requested
+
+@functools.lru_cache(maxsize=None)
+def group_members():
+    """
+    UKPRNs of the members of each group in learning-providers-plus.csv
+    """
+    institutions = pd.read_csv("learning-providers-plus.csv", usecols=["UKPRN", "GROUPS"]).dropna()
+    members = collections.defaultdict(set)
+    for ukprn, groups in zip(institutions["UKPRN"], institutions["GROUPS"]):
+        for group in groups.split(","):
+            members[group.strip()].add(ukprn)
+    return {group: frozenset(ukprns) for group, ukprns in members.items()}
+
+def prepare(data):
+    """
+    Number each (Year, Subject, Metric) group of a dataset with UKPRNs
+    """
+    keys = [c for c in ["Year", "Subject", "Metric"] if c in data.columns]
+    data = data.reset_index(drop=True)
+    return Ranked(data, data.groupby(keys, sort=False).ngroup().values, {})
+
+def group_mask(ranked, group):
+    """
+    Boolean mask of the rows belonging to a peer group label or list of UKPRNs
+    """
+    if isinstance(group, str):
+        if group not in group_members():
+            raise ValueError("Unknown group {}, options include: {}".format(group, ", ".join(sorted(group_members()))))
+        key = group
+        members = group_members()[group]
+    else:
+        key = members = frozenset(group)
+    if key not in ranked.masks:
+        ranked.masks[key] = np.isin(ranked.data["UKPRN"].values, list(members))
+    return ranked.masks[key]
+
+def peer_ranks(ranked, group):
+    """
+    Rows of a peer group's members with their rank & decile within the group for each year, subject & metric
+    """
+    mask = group_mask(ranked, group)
+    data = ranked.data.loc[mask].copy()
+    ranks = data["Rank"].groupby(ranked.groups[mask])
+    data["Peer Rank"] = ranks.rank(ascending=True, method="min") # Rank on existing rank rather than value to avoid detecting SSR metrics etc.
+    position = ranks.rank(ascending=False, method="first") # As pd.qcut on the rank in the scripts, but for all groups at once
+    count = ranks.transform("count")
+    data["Peer Decile"] = np.maximum(np.ceil((position - 1) * 10 / (count - 1)), 1).where(count > 1)
+    return data
@@ -0,0 +1,240 @@
+import os
+import re
+import time
+import glob
+import html
+import random
+import argparse
+import functools
+import threading
+import collections
+import http.server
+import importlib.util
+import urllib.parse
+import pandas as pd
+
+"""
+Local stand-in for the publishers' websites, so the fetch stages can be run end to end without contacting them.
+It replays the files checked in to this repository at the publishers' own URL paths:
+    • Times & Sunday Times, QS and THE tables are served from each script's JSON folder, along with the HTML pages the scripts search for the JSON filenames
+    • Times subject IDs are read from times_subject_ids.csv in this folder, a fixed fixture of the mock's own IDs (one per subject name, not the Times' real IDs)
+    • CUG pages aren't saved by the scripts, so they're rebuilt as HTML tables from the CUG output CSV files (pages without data get a 404)
+Latency, server errors and rate limiting (429 responses) can be added to test how the scripts cope, e.g.:
+    python3 mock_server.py --port 8000 --latency 0.2 --error-rate 0.05 --rate-limit 10
+Then point a script at the server with its publisher's environment variable (TIMES_URL, QS_URL, THE_URL or CUG_URL), e.g.:
+    TIMES_URL=http://localhost:8000 python3 times_institutional.py
+While their base URL isn't the publisher's own, the scripts don't save fetched tables or the Times subject ID index, so the checked-in files are left as they are.
+"""
+
+root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+times = os.path.join(root, "Times and Sunday Times")
+qs = os.path.join(root, "QS", "World University Rankings")
+the = os.path.join(root, "Times Higher Education", "World University Rankings")
+cug = os.path.join(root, "Complete University Guide")
+fixtures = os.path.dirname(os.path.abspath(__file__))
+
+Faults = collections.namedtuple("Faults", ["latency", "jitter", "error_rate", "error_status", "rate_limit"])
+
+def load_script(path):
+    """
+    Import a league table script from its file (the folder names aren't valid package names)
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def read_file(path):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+@functools.lru_cache(maxsize=None)
+def times_subject_files():
+    """
+    JSON file for each (year, ID) of the Times subject tables
+    """
+    files = {}
+    for year, subject, table in pd.read_csv(os.path.join(fixtures, "times_subject_ids.csv"))[["Year", "ID", "Table"]].itertuples(index=False):
+        files[(str(year), str(subject))] = os.path.join(times, "Subjects", "JSON", str(year), "{}.json".format(table))
+    return files
+
+@functools.lru_cache(maxsize=None)
+def qs_files():
+    """
+    Indicators filename for each QS page, and the JSON file for each indicators filename
+    """
+    pages, files = {}, {}
+    for file in glob.glob(os.path.join(qs, "Institutional", "JSON", "*.json")):
+        year = os.path.splitext(os.path.basename(file))[0]
+        pages[("world-university-rankings", year)] = "{}0_indicators.txt".format(year)
+        files["{}0_indicators.txt".format(year)] = file
+    lookup = pd.read_csv(os.path.join(qs, "Subjects", "lookup.csv"), index_col=[0,1])
+    for year in lookup.columns:
+        for number, ((category, subject), slug) in enumerate(lookup[year].items(), 1):
+            file = os.path.join(qs, "Subjects", "JSON", year, "{}.json".format(subject))
+            if type(slug) == str and os.path.exists(file):
+                pages[("university-subject-rankings", year, slug)] = "{}{}_indicators.txt".format(year, number)
+                files["{}{}_indicators.txt".format(year, number)] = file
+    return pages, files
+
+@functools.lru_cache(maxsize=None)
+def the_files():
+    """
+    JSON filename for each THE subject page, and the JSON file for each filename
+    """
+    pages, files = {}, {}
+    subjects = load_script(os.path.join(the, "Subjects", "the_subjects.py")).subjects
+    for file in glob.glob(os.path.join(the, "Institutional", "JSON", "*.json")):
+        files["world_university_rankings_{}.json".format(os.path.splitext(os.path.basename(file))[0])] = file
+    for folder in glob.glob(os.path.join(the, "Subjects", "JSON", "*")):
+        year = os.path.basename(folder)
+        for subject_name, subject_slug in subjects.items():
+            json_name = "{}_{}.json".format(subject_slug.replace("-", "_"), year) # Only word characters, as the script expects
+            if os.path.exists(os.path.join(folder, "{}.json".format(subject_name))):
+                pages[(year, subject_slug)] = json_name
+                files[json_name] = os.path.join(folder, "{}.json".format(subject_name))
+    return pages, files
+
+@functools.lru_cache(maxsize=None)
+def cug_data(table):
+    file = os.path.join(cug, table, "Complete University Guide {}.csv".format(table))
+    if os.path.exists(file):
+        data = pd.read_csv(file, dtype=str, keep_default_na=False) # Keep original values such as 'n/a'
+        data["Rank"] = pd.to_numeric(data["Rank"], errors="coerce")
+        return data
+
+def cug_page(year, subject=None):
+    """
+    Rebuild a CUG wide table page from the output CSV, with the original values and the overall rank
+    """
+    data = cug_data("Institutional" if subject is None else "Subjects")
+    if data is None:
+        return None
+    data = data.loc[data["Year"] == year]
+    if subject is not None:
+        data = data.loc[data["Subject"] == subject]
+    if not len(data):
+        return None
+    table = data.pivot_table(index="Institution", columns="Metric", values="Value", aggfunc="first", sort=False).fillna("") # In the order of the original page
+    ranks = data.loc[data["Metric"] == "Overall Score"].drop_duplicates("Institution").set_index("Institution")["Rank"]
+    rows = ["<tr>{}</tr>".format("".join("<th>{}</th>".format(html.escape(c)) for c in ["Rank", "University Name"] + list(table.columns)))]
+    for institution, values in table.iterrows():
+        rank = ranks.get(institution)
+        cells = ["{:.0f}".format(rank) if pd.notnull(rank) else "", institution] + list(values)
+        rows.append("<tr>{}</tr>".format("".join("<td>{}</td>".format(html.escape(str(c))) for c in cells)))
+    return '<html><body><table class="league-table-table">{}</table></body></html>'.format("".join(rows))
+
+def respond(path):
+    """
+    Content type and body for a request path, or None for a 404
+    """
+    url = urllib.parse.urlsplit(path)
+    query = urllib.parse.parse_qs(url.query)
+    path = urllib.parse.unquote(url.path)
+    match = re.match(r"/education/university_guide/active/UniversityGuide/getTable/type/rank/year/(\d+)$", path)
+    if match:
+        return "application/json", read_file(os.path.join(times, "Institutional", "JSON", "{}.json".format(match.group(1))))
+    match = re.match(r"/education/university_guide/active/UniversityGuide/getTable/type/imported/year/(\d+)/id/(\d+)$", path)
+    if match:
+        file = times_subject_files().get(match.groups())
+        return "application/json", read_file(file) if file else None
+    match = re.match(r"/university-rankings/(world-university-rankings)/(\d+)$|/university-rankings/(university-subject-rankings)/(\d+)/([\w-]+)$", path)
+    if match:
+        indicators = qs_files()[0].get(tuple(g for g in match.groups() if g))
+        return "text/html", '<html><script>var indicators = "/sites/default/files/qs-rankings-data/{}";</script></html>'.format(indicators) if indicators else None
+    match = re.match(r"/sites/default/files/qs-rankings-data/(\d+_indicators\.txt)$", path)
+    if match:
+        file = qs_files()[1].get(match.group(1))
+        return "text/plain", read_file(file) if file else None
+    match = re.match(r"/world-university-rankings/(\d+)/world-ranking$", path)
+    if match:
+        json_name = "world_university_rankings_{}.json".format(match.group(1))
+        return "text/html", '<html><script>{{"url":"https:\\/\\/www.timeshighereducation.com\\/sites\\/default\\/files\\/the_data_rankings\\/{}"}}</script></html>'.format(json_name) if json_name in the_files()[1] else None
+    match = re.match(r"/world-university-rankings/(\d+)/subject-ranking/([\w-]+)$", path)
+    if match:
+        json_name = the_files()[0].get(match.groups())
+        return "text/html", '<html><script>{{"url":"https:\\/\\/www.timeshighereducation.com\\/sites\\/default\\/files\\/the_data_rankings\\/{}"}}</script></html>'.format(json_name) if json_name else None
+    match = re.match(r"/sites/default/files/the_data_rankings/(\w+\.json)$", path)
+    if match:
+        file = the_files()[1].get(match.group(1))
+        return "application/json", read_file(file) if file else None
+    if path == "/league-tables/rankings" and "y" in query:
+        return "text/html", cug_page(query["y"][0], query["s"][0] if "s" in query else None)
+    return "text/plain", None
+
+class Server(http.server.ThreadingHTTPServer):
+    """
+    HTTP server holding the faults to inject and the times of recent requests for rate limiting
+    """
+    def __init__(self, address, faults, seed=None, quiet=False):
+        super().__init__(address, Handler)
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.recent = collections.deque()
+        self.lock = threading.Lock()
+        self.quiet = quiet
+
+def fault(server):
+    """
+    Status code to return instead of the page (429 if over the rate limit, or a random error), or None
+    """
+    with server.lock:
+        now = time.monotonic()
+        while server.recent and now - server.recent[0] > 1:
+            server.recent.popleft()
+        server.recent.append(now)
+        if server.faults.rate_limit and len(server.recent) > server.faults.rate_limit:
+            return 429
+        if server.rng.random() < server.faults.error_rate:
+            return server.faults.error_status
+        delay = server.faults.latency + server.rng.uniform(0, server.faults.jitter)
+    time.sleep(delay) # Sleep outside the lock so that concurrent requests are delayed together
+    return None
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status = fault(self.server)
+        content_type, body = "text/plain", "Error {}".format(status)
+        if status is None:
+            content_type, body = respond(self.path)
+            status = 200 if body is not None else 404
+            body = body if body is not None else "Not found"
+        body = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the checked-in league table data at the publishers' URL paths")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="Seconds to wait before each response")
+    parser.add_argument("--jitter", type=float, default=0, help="Up to this many seconds added at random to the latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="Status code of the errors")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests per second allowed before returning 429 (default unlimited)")
+    parser.add_argument("--seed", type=int, help="Seed for the random errors & jitter")
+    parser.add_argument("--quiet", action="store_true", help="Don't log each request")
+    args = parser.parse_args()
+    faults = Faults(args.latency, args.jitter, args.error_rate, args.error_status, args.rate_limit)
+    server = Server((args.host, args.port), faults, args.seed, args.quiet)
+    print("Serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
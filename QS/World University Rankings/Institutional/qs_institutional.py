@@ -1,10 +1,20 @@
 import requests
 import os
 import re
+import collections
 import json
 import pandas as pd
 from bs4 import BeautifulSoup
 
+publisher_url = "https://www.topuniversities.com"
+base_url = os.environ.get("QS_URL", publisher_url) # Publisher's site, set QS_URL to use another (e.g. the mock server)
+save_fetched = base_url == publisher_url # Tables fetched from anywhere else aren't saved over the JSON files
+rank_spec = re.compile(r"(\d+)(?:\s*[-\u2013\u2014]\s*(\d+)|(\+))?") # Official ranks such as '12', '=12', '501-510' or '1001+'
+
+id_columns = ["UNIVERSITY", "LOCATION", "REGION", "# RANK.1"]
+metrics = ["Academic Reputation", "Employer Reputation", "Faculty Student", "International Faculty", "International Students", "Citations per Faculty", "OVERALL SCORE"]
+ignored_spec = re.compile(r"SCORE(\.\d+)?$|\d*(_rank|_rank_d)?$|Unnamed: \d+$|STARS$|# RANK$") # Columns which are expected but dropped (indicator ranks, internal IDs etc.)
+
 def fetch_json(years):
     """
     Fetch league table as JSON files for each year & save to disk
@@ -12,13 +22,15 @@ def fetch_json(years):
     if not os.path.exists("JSON"):
         os.makedirs("JSON")
     for year in years:
-        url = "https://www.topuniversities.com/university-rankings/world-university-rankings"
+        url = base_url + "/university-rankings/world-university-rankings"
         r = requests.get("{}/{}".format(url, year))
         json_url = re.search("[\d]*_indicators.txt", r.text).group(0)
-        url = "https://www.topuniversities.com/sites/default/files/qs-rankings-data/"
+        url = base_url + "/sites/default/files/qs-rankings-data/"
         r = requests.get(url + json_url)
-        with open(os.path.join("JSON", "{}.json".format(year)), "w") as f:
-            json.dump(r.json(), f)
+        json_data = r.json()
+        if save_fetched:
+            with open(os.path.join("JSON", "{}.json".format(year)), "w") as f:
+                json.dump(json_data, f)
 
 def json_to_csv(years):
     """
@@ -37,6 +49,54 @@ def json_to_csv(years):
             csv_data.rename(columns=csv_columns, inplace=True)
             csv_data.to_csv(os.path.join("CSV", "{}.csv".format(year)), index=False)
 
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each year's headers against the expected columns before melting
+    """
+    headers = {}
+    for year in years:
+        headers[(year, None)] = list(pd.read_csv(os.path.join("CSV", "{}.csv".format(year)), nrows=0).columns)
+    compare_schema(headers)
+
+def parse_ranks(ranks):
+    """
+    Split official ranks into integer lower and upper bounds, flagging banded ranks (open bands such as '1001+' have no upper bound)
+    """
+    bounds = ranks.astype(str).str.extract(rank_spec)
+    lower = pd.to_numeric(bounds[0]).astype("Int64")
+    upper = pd.to_numeric(bounds[1]).astype("Int64")
+    banded = bounds[1].notnull() | bounds[2].notnull()
+    return pd.DataFrame({
+        "Rank Lower": lower,
+        "Rank Upper": upper.where(banded, lower),
+        "Is Banded": banded.astype("Int64").where(lower.notnull())
+    })
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' and concatenate into one DataFrame
@@ -44,30 +104,36 @@ def concat_data(years):
     data = []
     for year in years:
         csv_data = pd.read_csv(os.path.join("CSV", "{}.csv".format(year)))
-        csv_data = pd.melt(csv_data, id_vars=["UNIVERSITY", "LOCATION", "REGION"], var_name="Metric", value_name="Value")
+        official_ranks = csv_data["# RANK.1"].apply(lambda x: BeautifulSoup(x, "lxml").get_text() if type(x) is str else x)
+        csv_data = csv_data.join(parse_ranks(official_ranks)) # Official rank bounds are carried through to every metric of the same row
+        csv_data = pd.melt(csv_data, id_vars=["UNIVERSITY", "LOCATION", "REGION", "Rank Lower", "Rank Upper", "Is Banded"], var_name="Metric", value_name="Value")
         csv_data["Year"] = year
         data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
+
+def check_keys(data, keys):
+    """
+    Raise an error if an institution has more than one value for the same metric, rather than silently keeping one of them
+    """
+    duplicates = data.duplicated(subset=keys, keep=False) # Hashes the key columns so runs in linear time
+    if duplicates.any():
+        raise ValueError("Duplicate values for:\n{}".format(data.loc[duplicates, keys].drop_duplicates().to_string(index=False)))
 
 def clean_data(data):
     """
     Rename columns, tidy metric names, add numerical values
     """
     data.rename({"UNIVERSITY": "Institution", "LOCATION": "Location", "REGION": "Region"}, axis=1, inplace=True)
-    metrics = ["Academic Reputation", "Employer Reputation", "Faculty Student", "International Faculty", "International Students", "Citations per Faculty", "OVERALL SCORE", "# RANK.1"]
     data = data.copy().loc[data["Metric"].isin(metrics)]
     data["Institution"] = data["Institution"].apply(lambda x: BeautifulSoup(x, "lxml").get_text())
     data["Value"] = data["Value"].apply(lambda x: BeautifulSoup(x, "lxml").get_text() if type(x) is str else x)
     data.drop_duplicates(inplace=True)
-    overall_ranks = data.copy().loc[data["Metric"] == "# RANK.1", ["Institution", "Value", "Year"]]
-    overall_ranks.rename({"Value": "Rank"}, axis=1, inplace=True)
-    overall_ranks["Metric"] = "OVERALL SCORE"
-    overall_ranks["Rank"] = overall_ranks["Rank"].str.extract("(\d+)", expand=False) # Get first number i.e. '501' from '501-510'
-    data = data.loc[data["Metric"] != "# RANK.1"]
+    check_keys(data, ["Institution", "Year", "Metric"])
+    data[["Rank Lower", "Rank Upper", "Is Banded"]] = data[["Rank Lower", "Rank Upper", "Is Banded"]].where(data["Metric"] == "OVERALL SCORE") # Official rank bounds only apply to the overall score
     data["Numeric Value"] = pd.to_numeric(data["Value"], errors="coerce") # Coerce will turn blanks to NaNs
-    return data, overall_ranks
+    return data
 
-def rank_metrics(data, overall_ranks):
+def rank_metrics(data):
     """
     Calculate rank and decile for each metric by year
     """
@@ -75,15 +141,40 @@ def rank_metrics(data, overall_ranks):
     data.loc[data["Metric"] != "OVERALL SCORE", "Decile"] = data.loc[data["Metric"] != "OVERALL SCORE"].groupby(["Year", "Metric"])["Numeric Value"].transform(
         lambda x: pd.qcut(x.rank(method="first"), 10, labels=range(1,11)) # Calculate deciles on ranked data to avoid duplicate bin edges as https://stackoverflow.com/a/40548606/2950747
     )
-    data.set_index(keys=["Institution", "Year", "Metric"], inplace=True)
-    overall_ranks.set_index(keys=["Institution", "Year", "Metric"], inplace=True)
-    data.update(overall_ranks)
-    return data.reset_index()
+    official = data["Rank Lower"].notnull()
+    data.loc[official, "Rank"] = data.loc[official, "Rank Lower"] # Use the official (lower bound) rank for the overall score
+    return data
+
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "QS WUR Institutional.csv" # Add .gz to the filename to save compressed
+columns = ["Institution", "Location", "Region", "Rank Lower", "Rank Upper", "Is Banded", "Metric", "Value", "Year", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
 
 years = [2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
-fetch_json(years)
-json_to_csv(years)
-data = concat_data(years)
-data, overall_ranks = clean_data(data)
-data = rank_metrics(data, overall_ranks)
-data.to_csv("QS WUR Institutional.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    fetch_json(years)
+    json_to_csv(years)
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
@@ -1,9 +1,22 @@
 import requests
 import os
 import re
+import collections
 import json
+import numpy as np
 import pandas as pd
 
+publisher_url = "https://www.timeshighereducation.com"
+base_url = os.environ.get("THE_URL", publisher_url) # Publisher's site, set THE_URL to use another (e.g. the mock server)
+save_fetched = base_url == publisher_url # Tables fetched from anywhere else aren't saved over the JSON files
+numeric_spec = re.compile(r"[\d.]+") # First number in THE values
+rank_spec = re.compile(r"(\d+)(?:\s*[-\u2013\u2014]\s*(\d+)|(\+))?") # Official ranks such as '12', '=12', '501–510' or '1001+'
+dashes = str.maketrans({"\u2013": "-", "\u2014": "-"})
+
+id_columns = ["name", "location", "rank"]
+metrics = ["scores_citations", "scores_industry_income", "scores_international_outlook", "scores_overall", "scores_research", "scores_teaching"]
+ignored_spec = re.compile(r"(aliases|apply_link|member_level|nid|rank_order|record_type|subjects_offered|url)$|stats_|scores_\w+_rank$") # Columns which are expected but dropped
+
 def fetch_json(years):
     """
     Fetch league table as JSON files for each year & save to disk
@@ -11,14 +24,16 @@ def fetch_json(years):
     if not os.path.exists("JSON"):
         os.makedirs("JSON")
     for year in years:
-        url = "https://www.timeshighereducation.com/world-university-rankings"
+        url = base_url + "/world-university-rankings"
         r = requests.get("{}/{}/world-ranking".format(url, year), headers = {"User-Agent": None}) # U-A required to avoid 403
         json_url = re.search("world_university_rankings_[\w]*\.json", r.text).group(0)
-        url = "https://www.timeshighereducation.com/sites/default/files/the_data_rankings/"
+        url = base_url + "/sites/default/files/the_data_rankings/"
         r = requests.get(url + json_url, headers = {"User-Agent": None})
         if r:
-            with open(os.path.join("JSON", "{}.json".format(year)), "w") as f:
-                json.dump(r.json(), f)
+            json_data = r.json()
+            if save_fetched:
+                with open(os.path.join("JSON", "{}.json".format(year)), "w") as f:
+                    json.dump(json_data, f)
 
 def json_to_csv(years):
     """
@@ -32,6 +47,54 @@ def json_to_csv(years):
             csv_data = pd.DataFrame(data=json_data["data"])
             csv_data.to_csv(os.path.join("CSV", "{}.csv".format(year)), index=False)
 
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each year's headers against the expected columns before melting
+    """
+    headers = {}
+    for year in years:
+        headers[(year, None)] = list(pd.read_csv(os.path.join("CSV", "{}.csv".format(year)), nrows=0).columns)
+    compare_schema(headers)
+
+def parse_ranks(ranks):
+    """
+    Split official ranks into integer lower and upper bounds, flagging banded ranks (open bands such as '1001+' have no upper bound)
+    """
+    bounds = ranks.astype(str).str.extract(rank_spec)
+    lower = pd.to_numeric(bounds[0]).astype("Int64")
+    upper = pd.to_numeric(bounds[1]).astype("Int64")
+    banded = bounds[1].notnull() | bounds[2].notnull()
+    return pd.DataFrame({
+        "Rank Lower": lower,
+        "Rank Upper": upper.where(banded, lower),
+        "Is Banded": banded.astype("Int64").where(lower.notnull())
+    })
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' and concatenate into one DataFrame
@@ -39,31 +102,54 @@ def concat_data(years):
     data = []
     for year in years:
         csv_data = pd.read_csv(os.path.join("CSV", "{}.csv".format(year)))
-        csv_data = pd.melt(csv_data, id_vars=["name", "location"], var_name="Metric", value_name="Value")
+        csv_data = csv_data.join(parse_ranks(csv_data["rank"])) # Official rank bounds are carried through to every metric of the same row
+        csv_data = pd.melt(csv_data, id_vars=["name", "location", "Rank Lower", "Rank Upper", "Is Banded"], var_name="Metric", value_name="Value")
         csv_data["Year"] = year
         data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
+
+def numeric_match(value):
+    """
+    Get the first number in a value, i.e. the lowest score from banded 'Overall' scores
+    """
+    match = numeric_spec.search(str(value))
+    return match.group(0) if match else ""
+
+def numeric_values(values):
+    """
+    Convert values to numbers by parsing each unique value once, also returning the values which couldn't be converted
+    """
+    codes, uniques = pd.factorize(values)
+    numbers = pd.to_numeric([numeric_match(value) for value in uniques], errors="coerce") # Coerce will turn blanks to NaNs
+    coerced = [str(value) for value, number in zip(uniques, numbers) if np.isnan(number)]
+    numbers = np.append(numbers, np.nan) # Missing values have a code of -1 so pick up the trailing NaN
+    return pd.Series(numbers[codes], index=values.index), coerced
+
+def check_keys(data, keys):
+    """
+    Raise an error if an institution has more than one value for the same metric, rather than silently keeping one of them
+    """
+    duplicates = data.duplicated(subset=keys, keep=False) # Hashes the key columns so runs in linear time
+    if duplicates.any():
+        raise ValueError("Duplicate values for:\n{}".format(data.loc[duplicates, keys].drop_duplicates().to_string(index=False)))
 
 def clean_data(data):
     """
     Rename columns, tidy metric names, add numerical values
     """
     data.rename({"name": "Institution", "location": "Location"}, axis=1, inplace=True)
-    metrics = ["scores_citations", "scores_industry_income", "scores_international_outlook", "scores_overall", "scores_research", "scores_teaching", "rank"]
     data = data.copy().loc[data["Metric"].isin(metrics)]
     data["Metric"] = data["Metric"].apply(lambda x: " ".join([w.capitalize() for w in x.replace("scores_", "").split("_")]))
-    data["Value"] = data["Value"].astype(str).str.replace("\u2013", "-", regex=False)
-    data["Value"] = data["Value"].astype(str).str.replace("\u2014", "-", regex=False)
+    data["Value"] = data["Value"].astype(str).str.translate(dashes)
     data.drop_duplicates(inplace=True)
-    overall_ranks = data.copy().loc[data["Metric"] == "Rank", ["Location", "Institution", "Value", "Year"]]
-    overall_ranks.rename({"Value": "Rank"}, axis=1, inplace=True)
-    overall_ranks["Metric"] = "Overall"
-    overall_ranks["Rank"] = overall_ranks["Rank"].str.extract("(\d+)", expand=False) # Get first number i.e. '501' from '501-510'
-    data = data.loc[data["Metric"] != "Rank"]
-    data["Numeric Value"] = pd.to_numeric(data["Value"].str.extract("([\d.]+)", expand=False), errors="coerce") # Also capture lowest score from banded 'Overall' scores
-    return data, overall_ranks
+    check_keys(data, ["Location", "Institution", "Year", "Metric"])
+    data[["Rank Lower", "Rank Upper", "Is Banded"]] = data[["Rank Lower", "Rank Upper", "Is Banded"]].where(data["Metric"] == "Overall") # Official rank bounds only apply to the overall score
+    data["Numeric Value"], coerced = numeric_values(data["Value"])
+    if coerced:
+        print("Values converted to NaN:", ", ".join(sorted(coerced)))
+    return data
 
-def rank_metrics(data, overall_ranks):
+def rank_metrics(data):
     """
     Calculate rank and decile for each metric by year
     """
@@ -71,15 +157,40 @@ def rank_metrics(data, overall_ranks):
     data.loc[data["Metric"] != "Overall", "Decile"] = data.loc[data["Metric"] != "Overall"].groupby(["Year", "Metric"])["Numeric Value"].transform(
         lambda x: pd.qcut(x.rank(method="first"), 10, labels=range(1,11)) # Calculate deciles on ranked data to avoid duplicate bin edges as https://stackoverflow.com/a/40548606/2950747
     )
-    data.set_index(keys=["Location", "Institution", "Year", "Metric"], inplace=True)
-    overall_ranks.set_index(keys=["Location", "Institution", "Year", "Metric"], inplace=True)
-    data.update(overall_ranks)
-    return data.reset_index()
+    official = data["Rank Lower"].notnull()
+    data.loc[official, "Rank"] = data.loc[official, "Rank Lower"] # Use the official (lower bound) rank for the overall score
+    return data
+
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "THE WUR Institutional.csv" # Add .gz to the filename to save compressed
+columns = ["Institution", "Location", "Rank Lower", "Rank Upper", "Is Banded", "Metric", "Value", "Year", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
 
 years = [2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
-fetch_json(years)
-json_to_csv(years)
-data = concat_data(years)
-data, overall_ranks = clean_data(data)
-data = rank_metrics(data, overall_ranks)
-data.to_csv("THE WUR Institutional.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    fetch_json(years)
+    json_to_csv(years)
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
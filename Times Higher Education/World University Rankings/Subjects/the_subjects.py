@@ -1,40 +1,56 @@
 import requests
 import os
 import re
+import collections
 import json
 import glob
+import numpy as np
 import pandas as pd
 
+publisher_url = "https://www.timeshighereducation.com"
+base_url = os.environ.get("THE_URL", publisher_url) # Publisher's site, set THE_URL to use another (e.g. the mock server)
+save_fetched = base_url == publisher_url # Tables fetched from anywhere else aren't saved over the JSON files
+numeric_spec = re.compile(r"[\d.]+") # First number in THE values
+rank_spec = re.compile(r"(\d+)(?:\s*[-\u2013\u2014]\s*(\d+)|(\+))?") # Official ranks such as '12', '=12', '501–510' or '1001+'
+dashes = str.maketrans({"\u2013": "-", "\u2014": "-"})
+
+id_columns = ["name", "location", "rank"]
+metrics = ["scores_citations", "scores_industry_income", "scores_international_outlook", "scores_overall", "scores_research", "scores_teaching"]
+ignored_spec = re.compile(r"(aliases|apply_link|member_level|nid|rank_order|record_type|subjects_offered|url)$|stats_|scores_\w+_rank$") # Columns which are expected but dropped
+
+subjects = {
+    "Arts & Humanities": "arts-and-humanities",
+    "Clinical, Pre-clinical & Health": "clinical-pre-clinical-health",
+    "Life Sciences": "life-sciences",
+    "Physical sciences": "physical-sciences",
+    "Psychology": "psychology",
+    "Education": "education",
+    "Law": "law",
+    "Social Sciences": "social-sciences",
+    "Business & Economics": "business-and-economics",
+    "Computer Science": "computer-science",
+    "Engineering & Technology": "engineering-and-IT"
+}
+
 def fetch_json(years):
     """
     Fetch league table as JSON files for each year and subject & save to disk
     """
-    subjects = {
-        "Arts & Humanities": "arts-and-humanities",
-        "Clinical, Pre-clinical & Health": "clinical-pre-clinical-health",
-        "Life Sciences": "life-sciences",
-        "Physical sciences": "physical-sciences",
-        "Psychology": "psychology",
-        "Education": "education",
-        "Law": "law",
-        "Social Sciences": "social-sciences",
-        "Business & Economics": "business-and-economics",
-        "Computer Science": "computer-science",
-        "Engineering & Technology": "engineering-and-IT"
-    }
     for year in years:
         if not os.path.exists(os.path.join("JSON", str(year))):
             os.makedirs(os.path.join("JSON", str(year)))
         for subject_name, subject_slug in subjects.items():
-            url = "https://www.timeshighereducation.com/world-university-rankings"
+            url = base_url + "/world-university-rankings"
             r = requests.get("{}/{}/subject-ranking/{}".format(url, year, subject_slug), headers = {"User-Agent": None}) # U-A required to avoid 403
             json_url = re.search(r"the_data_rankings\\/([\w]*\.json)", r.text) # JSON filename doesn't always match subject_slug
             if json_url:
-                url = "https://www.timeshighereducation.com/sites/default/files/the_data_rankings/"
+                url = base_url + "/sites/default/files/the_data_rankings/"
                 r = requests.get(url + json_url.group(1), headers = {"User-Agent": None})
                 if r:
-                    with open(os.path.join("JSON", str(year), "{}.json".format(subject_name)), "w") as f:
-                        json.dump(r.json(), f)
+                    json_data = r.json()
+                    if save_fetched:
+                        with open(os.path.join("JSON", str(year), "{}.json".format(subject_name)), "w") as f:
+                            json.dump(json_data, f)
 
 def json_to_csv(years):
     """
@@ -50,6 +66,55 @@ def json_to_csv(years):
                 csv_name = os.path.splitext(os.path.basename(file))[0]
                 csv_data.to_csv(os.path.join("CSV", str(year), "{}.csv".format(csv_name)), index=False)
 
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each subject's headers against the expected columns before melting
+    """
+    headers = {}
+    for year in years:
+        for file in glob.glob(os.path.join("CSV", str(year), "*.csv")):
+            headers[(year, os.path.splitext(os.path.basename(file))[0])] = list(pd.read_csv(file, nrows=0).columns)
+    compare_schema(headers)
+
+def parse_ranks(ranks):
+    """
+    Split official ranks into integer lower and upper bounds, flagging banded ranks (open bands such as '1001+' have no upper bound)
+    """
+    bounds = ranks.astype(str).str.extract(rank_spec)
+    lower = pd.to_numeric(bounds[0]).astype("Int64")
+    upper = pd.to_numeric(bounds[1]).astype("Int64")
+    banded = bounds[1].notnull() | bounds[2].notnull()
+    return pd.DataFrame({
+        "Rank Lower": lower,
+        "Rank Upper": upper.where(banded, lower),
+        "Is Banded": banded.astype("Int64").where(lower.notnull())
+    })
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' and concatenate into one DataFrame
@@ -58,34 +123,55 @@ def concat_data(years):
     for year in years:
         for file in glob.glob(os.path.join("CSV", str(year), "*.csv")):
             csv_data = pd.read_csv(file)
-            csv_data = pd.melt(csv_data, id_vars=["name", "location"], var_name="Metric", value_name="Value")
+            csv_data = csv_data.join(parse_ranks(csv_data["rank"])) # Official rank bounds are carried through to every metric of the same row
+            csv_data = pd.melt(csv_data, id_vars=["name", "location", "Rank Lower", "Rank Upper", "Is Banded"], var_name="Metric", value_name="Value")
             csv_data["Year"] = year
             csv_data["Subject"] = os.path.splitext(os.path.basename(file))[0]
             data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
+
+def numeric_match(value):
+    """
+    Get the first number in a value, i.e. the lowest score from banded 'Overall' scores
+    """
+    match = numeric_spec.search(str(value))
+    return match.group(0) if match else ""
+
+def numeric_values(values):
+    """
+    Convert values to numbers by parsing each unique value once, also returning the values which couldn't be converted
+    """
+    codes, uniques = pd.factorize(values)
+    numbers = pd.to_numeric([numeric_match(value) for value in uniques], errors="coerce") # Coerce will turn blanks to NaNs
+    coerced = [str(value) for value, number in zip(uniques, numbers) if np.isnan(number)]
+    numbers = np.append(numbers, np.nan) # Missing values have a code of -1 so pick up the trailing NaN
+    return pd.Series(numbers[codes], index=values.index), coerced
+
+def check_keys(data, keys):
+    """
+    Raise an error if an institution has more than one value for the same metric, rather than silently keeping one of them
+    """
+    duplicates = data.duplicated(subset=keys, keep=False) # Hashes the key columns so runs in linear time
+    if duplicates.any():
+        raise ValueError("Duplicate values for:\n{}".format(data.loc[duplicates, keys].drop_duplicates().to_string(index=False)))
 
 def clean_data(data):
     """
     Rename columns, correct encoding issues, add numerical values
     """
     data.rename({"name": "Institution", "location": "Location"}, axis=1, inplace=True)
-    metrics = ["scores_citations", "scores_industry_income", "scores_international_outlook", "scores_overall", "scores_research", "scores_teaching", "rank"]
     data = data.copy().loc[data["Metric"].isin(metrics)]
     data["Metric"] = data["Metric"].apply(lambda x: " ".join([w.capitalize() for w in x.replace("scores_", "").split("_")]))
-    data["Value"] = data["Value"].astype(str).str.replace("\u2013", "-", regex=False)
-    data["Value"] = data["Value"].astype(str).str.replace("\u2014", "-", regex=False)
+    data["Value"] = data["Value"].astype(str).str.translate(dashes)
     data.drop_duplicates(inplace=True)
-    overall_ranks = data.copy().loc[data["Metric"] == "Rank", ["Location", "Institution", "Subject", "Value", "Year"]]
-    overall_ranks.rename({"Value": "Rank"}, axis=1, inplace=True)
-    overall_ranks["Metric"] = "Overall"
-    overall_ranks["Rank"] = overall_ranks["Rank"].str.extract("(\d+)", expand=False) # Get first number i.e. '501' from '501-510'
-    data = data.loc[data["Metric"] != "Rank"]
-    data["Numeric Value"] = data["Value"].astype(str)
-    data["Numeric Value"] = data["Numeric Value"].str.extract("([\d.]+)", expand=False) # Also capture lowest score from banded 'Overall' scores
-    data["Numeric Value"] = pd.to_numeric(data["Numeric Value"], errors="coerce")
-    return data, overall_ranks
-
-def rank_metrics(data, overall_ranks):
+    check_keys(data, ["Location", "Institution", "Subject", "Year", "Metric"])
+    data[["Rank Lower", "Rank Upper", "Is Banded"]] = data[["Rank Lower", "Rank Upper", "Is Banded"]].where(data["Metric"] == "Overall") # Official rank bounds only apply to the overall score
+    data["Numeric Value"], coerced = numeric_values(data["Value"])
+    if coerced:
+        print("Values converted to NaN:", ", ".join(sorted(coerced)))
+    return data
+
+def rank_metrics(data):
     """
     Calculate rank and decile for each metric by year
     """
@@ -93,15 +179,40 @@ def rank_metrics(data, overall_ranks):
     data.loc[data["Metric"] != "Overall", "Decile"] = data.loc[data["Metric"] != "Overall"].groupby(["Year", "Subject", "Metric"])["Numeric Value"].transform(
         lambda x: pd.qcut(x.rank(method="first"), 10, labels=range(1,11)) # Calculate deciles on ranked data to avoid duplicate bin edges as https://stackoverflow.com/a/40548606/2950747
     )
-    data.set_index(keys=["Location", "Institution", "Subject", "Year", "Metric"], inplace=True)
-    overall_ranks.set_index(keys=["Location", "Institution", "Subject", "Year", "Metric"], inplace=True)
-    data.update(overall_ranks)
-    return data.reset_index()
+    official = data["Rank Lower"].notnull()
+    data.loc[official, "Rank"] = data.loc[official, "Rank Lower"] # Use the official (lower bound) rank for the overall score
+    return data
+
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "THE WUR Subjects.csv" # Add .gz to the filename to save compressed
+columns = ["Institution", "Location", "Rank Lower", "Rank Upper", "Is Banded", "Metric", "Value", "Year", "Subject", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
 
 years = [2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
-fetch_json(years)
-json_to_csv(years)
-data = concat_data(years)
-data, overall_ranks = clean_data(data)
-data = rank_metrics(data, overall_ranks)
-data.to_csv("THE WUR Subjects.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    fetch_json(years)
+    json_to_csv(years)
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
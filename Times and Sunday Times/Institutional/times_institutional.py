@@ -1,9 +1,31 @@
 import requests
 import os
+import re
+import collections
 import json
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 
+publisher_url = "https://st.hitcreative.com"
+base_url = os.environ.get("TIMES_URL", publisher_url) # Publisher's site, set TIMES_URL to use another (e.g. the mock server)
+save_fetched = base_url == publisher_url # Tables fetched from anywhere else aren't saved over the JSON files
+numeric_spec = re.compile(r"[%*,]|\.\.") # Characters stripped from Times values before conversion to numbers
+
+id_columns = ["University"]
+metrics = ["Teaching quality (%)", "Student experience (%)", "Research quality (%)", "Entry standards (Ucas pts)", "Graduate prospects (%)", "Firsts/2:1s (%)", "Completion rate (%)", "Student-staff ratio", "Services/facilities spend (£)", "Total"]
+metric_names = {
+    "Completion rate": "Completion rate (%)",
+    "Ucas entry points": "Entry standards (Ucas pts)",
+    "Graduate prospects": "Graduate prospects (%)",
+    "Firsts / 2:1s": "Firsts/2:1s (%)",
+    "Research quality": "Research quality (%)",
+    "Services/facilities spend": "Services/facilities spend (£)",
+    "Services/ facilities spend (£)": "Services/facilities spend (£)",
+    "Student experience": "Student experience (%)"
+}
+ignored_spec = re.compile(r"(Rank|Last Year Rank)$") # Columns which are expected but dropped
+
 def fetch_json(years):
     """
     Fetch league table as JSON files for each year & save to disk
@@ -11,10 +33,12 @@ def fetch_json(years):
     if not os.path.exists("JSON"):
         os.makedirs("JSON")
     for year in years:
-        url = "https://st.hitcreative.com/education/university_guide/active/UniversityGuide/getTable/type/rank/year/"
+        url = base_url + "/education/university_guide/active/UniversityGuide/getTable/type/rank/year/"
         r = requests.get(url + str(year))
-        with open(os.path.join("JSON", "{}.json".format(year)), "w") as f:
-            json.dump(r.json(), f)
+        json_data = r.json()
+        if save_fetched:
+            with open(os.path.join("JSON", "{}.json".format(year)), "w") as f:
+                json.dump(json_data, f)
 
 def json_to_csv(years):
     """
@@ -29,6 +53,41 @@ def json_to_csv(years):
             csv_data = pd.DataFrame(data=json_data["rows"], columns=columns)
             csv_data.to_csv(os.path.join("CSV", "{}.csv".format(year)), index=False)
 
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each year's headers against the expected columns (after renaming) before melting
+    """
+    headers = {}
+    for year in years:
+        columns = pd.read_csv(os.path.join("CSV", "{}.csv".format(year)), nrows=0).columns
+        headers[(year, None)] = [metric_names.get(c, c) for c in [BeautifulSoup(c, "lxml").get_text() for c in columns]]
+    compare_schema(headers)
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' and concatenate into one DataFrame
@@ -39,7 +98,17 @@ def concat_data(years):
         csv_data = pd.melt(csv_data, id_vars=["University"], var_name="Metric", value_name="Value")
         csv_data["Year"] = year
         data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
+
+def numeric_values(values):
+    """
+    Convert values to numbers by parsing each unique value once, also returning the values which couldn't be converted
+    """
+    codes, uniques = pd.factorize(values)
+    numbers = pd.to_numeric([numeric_spec.sub("", str(value)) for value in uniques], errors="coerce") # Coerce will turn blanks to NaNs
+    coerced = [str(value) for value, number in zip(uniques, numbers) if np.isnan(number)]
+    numbers = np.append(numbers, np.nan) # Missing values have a code of -1 so pick up the trailing NaN
+    return pd.Series(numbers[codes], index=values.index), coerced
 
 def clean_data(data):
     """
@@ -48,21 +117,12 @@ def clean_data(data):
     data["Institution"] = data["University"].apply(lambda x: BeautifulSoup(x, "lxml").get_text())
     data["Metric"] = data["Metric"].apply(lambda x: BeautifulSoup(x, "lxml").get_text())
     data.drop("University", axis=1, inplace=True)
-    data["Metric"].replace({
-        "Completion rate": "Completion rate (%)",
-        "Ucas entry points": "Entry standards (Ucas pts)",
-        "Graduate prospects": "Graduate prospects (%)",
-        "Firsts / 2:1s": "Firsts/2:1s (%)",
-        "Research quality": "Research quality (%)",
-        "Services/facilities spend": "Services/facilities spend (£)",
-        "Services/ facilities spend (£)": "Services/facilities spend (£)",
-        "Student experience": "Student experience (%)"
-    }, inplace=True)
+    data["Metric"].replace(metric_names, inplace=True)
     data = data.loc[data["Metric"] != "Rank"] # Rank is dropped in favour of re-calculating it on the 'Total' metric
     data = data.loc[data["Metric"] != "Last Year Rank"]
-    data["Numeric Value"] = data["Value"].astype(str)
-    data["Numeric Value"] = data["Numeric Value"].str.replace(",", "", regex=False)
-    data["Numeric Value"] = pd.to_numeric(data["Numeric Value"], errors="coerce") # Coerce will turn blanks to NaNs
+    data["Numeric Value"], coerced = numeric_values(data["Value"])
+    if coerced:
+        print("Values converted to NaN:", ", ".join(sorted(coerced)))
     return data
 
 def rank_metrics(data):
@@ -81,10 +141,36 @@ def rank_metrics(data):
     )
     return data_exc_ssr.append(data_inc_ssr)
 
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "Times & Sunday Times Institutional.csv" # Add .gz to the filename to save compressed
+columns = ["Metric", "Value", "Year", "Institution", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
+
 years = [2014, 2015, 2016, 2017, 2018, 2019, 2020]
-fetch_json(years)
-json_to_csv(years)
-data = concat_data(years)
-data = clean_data(data)
-data = rank_metrics(data)
-data.to_csv("Times & Sunday Times Institutional.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    fetch_json(years)
+    json_to_csv(years)
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)
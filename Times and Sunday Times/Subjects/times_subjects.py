@@ -1,25 +1,83 @@
 import requests
 import os
+import re
+import collections
 import json
 import glob
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 
+publisher_url = "https://st.hitcreative.com"
+base_url = os.environ.get("TIMES_URL", publisher_url) # Publisher's site, set TIMES_URL to use another (e.g. the mock server)
+save_fetched = base_url == publisher_url # Tables fetched from anywhere else aren't saved over the JSON files
+numeric_spec = re.compile(r"[%*,]|\.\.") # Characters stripped from Times values before conversion to numbers
+subject_ids = range(300, 500) # Range of IDs used by the Times for subject tables
+new_ids = 20 # Number of IDs above the highest known ID to probe for new subjects
+
+id_columns = ["University"]
+column_names = {"Institution": "University"} # Some subjects use 'Institution' instead
+metrics = ["Total score", "Entry points", "Research quality", "Student experience", "Graduate prospects", "Teaching quality", "Ofsted rating"]
+metric_names = {
+    "Overall rating": "Total score",
+    "Entry standards": "Entry points",
+    "Research rating": "Research quality"
+}
+ignored_spec = re.compile(r"(Subject rank|Overall rank)$") # Columns which are expected but dropped
+
+def load_index():
+    """
+    Load the index of subject IDs found for each year (delete a year's rows to rediscover its subjects), which is created by the first run
+    The index only holds the publisher's IDs, so it isn't used when fetching from anywhere else (e.g. the mock server)
+    """
+    if save_fetched and os.path.exists("subject_ids.csv"):
+        return pd.read_csv("subject_ids.csv")
+    return pd.DataFrame(columns=["Year", "ID", "Table"])
+
+def candidate_ids(index, year):
+    """
+    IDs to request for a year: its known subjects if indexed, otherwise IDs known from other years and a few above them (or every ID if there's no index)
+    """
+    known = index.loc[index["Year"] == year, "ID"]
+    if len(known):
+        return sorted(known)
+    if not len(index):
+        return list(subject_ids)
+    top = int(index["ID"].max())
+    return sorted(set(index["ID"].astype(int)) | set(range(top + 1, min(top + 1 + new_ids, subject_ids.stop))))
+
 def fetch_json(years):
     """
-    Fetch league table as JSON files for each year & subject & save to disk
+    Fetch league table as JSON files for each year & subject & save to disk, updating the index of subject IDs
     """
     if not os.path.exists("JSON"):
         os.makedirs("JSON")
+    index = load_index()
+    found, failed, missing = [], [], []
     for year in years:
         if not os.path.exists(os.path.join("JSON", str(year))):
             os.makedirs(os.path.join("JSON", str(year)))
-        for subject in range(300, 500):
-            url = "https://st.hitcreative.com/education/university_guide/active/UniversityGuide/getTable/type/imported/year"
+        for subject in candidate_ids(index, year):
+            url = base_url + "/education/university_guide/active/UniversityGuide/getTable/type/imported/year"
             r = requests.get("{}/{}/id/{}".format(url, year, subject))
             if r.status_code == 200:
-                with open(os.path.join("JSON", str(year), "{}.json".format(r.json()["table_name"])), "w") as f:
-                    json.dump(r.json(), f)
+                json_data = r.json()
+                if save_fetched:
+                    with open(os.path.join("JSON", str(year), "{}.json".format(json_data["table_name"])), "w") as f:
+                        json.dump(json_data, f)
+                found.append({"Year": year, "ID": subject, "Table": json_data["table_name"]})
+            elif r.status_code == 404:
+                missing.append((year, subject))
+            else: # Kept in the index (without a table name if it's new) so that it's requested again next time
+                print("Times {} subject ID {} returned status {}".format(year, subject, r.status_code))
+                failed.append({"Year": year, "ID": subject, "Table": None})
+    replaced = set(missing) | set((row["Year"], row["ID"]) for row in found)
+    kept = index.loc[[key not in replaced for key in zip(index["Year"], index["ID"])]] # Only a 404 removes a known ID
+    known = set(zip(kept["Year"], kept["ID"]))
+    failed = [row for row in failed if (row["Year"], row["ID"]) not in known]
+    index = pd.concat([kept, pd.DataFrame(found + failed, columns=["Year", "ID", "Table"])], axis=0)
+    if save_fetched:
+        index.sort_values(["Year", "ID"]).to_csv("subject_ids.csv", index=False)
 
 def json_to_csv(years):
     """
@@ -38,6 +96,42 @@ def json_to_csv(years):
                 csv_name = os.path.splitext(os.path.basename(file))[0]
                 csv_data.to_csv(os.path.join("CSV", str(year), "{}.csv".format(csv_name)), index=False)
 
+def compare_schema(headers):
+    """
+    Report columns which aren't expected & metrics missing from a whole year, raising an error if any table lacks an identifying column
+    """
+    missing = []
+    unexpected = collections.defaultdict(list)
+    found = collections.defaultdict(set)
+    for (year, table), columns in headers.items():
+        absent = [c for c in id_columns if c not in columns]
+        if absent:
+            missing.append("{}: {}".format(" ".join(str(k) for k in (year, table) if k), ", ".join(absent)))
+        for c in columns:
+            if c in metrics:
+                found[year].add(c)
+            elif c not in id_columns and not ignored_spec.match(str(c)):
+                unexpected[c].append(year)
+    for c, in_years in unexpected.items():
+        print("Unexpected column {!r} in {}".format(c, ", ".join(str(y) for y in sorted(set(in_years)))))
+    for metric in metrics:
+        not_found = [y for y in sorted(set(year for year, table in headers)) if metric not in found[y]]
+        if not_found:
+            print("Metric {!r} not found in {}".format(metric, ", ".join(str(y) for y in not_found)))
+    if missing:
+        raise ValueError("Identifying columns missing from:\n{}".format("\n".join(missing)))
+
+def check_schema(years):
+    """
+    Check each subject's headers against the expected columns (after renaming) before melting
+    """
+    headers = {}
+    for year in years:
+        for file in glob.glob(os.path.join("CSV", str(year), "*.csv")):
+            columns = pd.read_csv(file, nrows=0).rename(column_names, axis=1).columns
+            headers[(year, os.path.splitext(os.path.basename(file))[0])] = [metric_names.get(c, c) for c in [BeautifulSoup(c, "lxml").get_text() for c in columns]]
+    compare_schema(headers)
+
 def concat_data(years):
     """
     Convert to long format, add 'Year' & 'Subject' and concatenate into one DataFrame
@@ -46,12 +140,22 @@ def concat_data(years):
     for year in years:
         for file in glob.glob(os.path.join("CSV", str(year), "*.csv")):
             csv_data = pd.read_csv(file)
-            csv_data = csv_data.rename({"Institution": "University"}, axis=1) # Some subjects use 'Institution' instead
+            csv_data = csv_data.rename(column_names, axis=1)
             csv_data = pd.melt(csv_data, id_vars=["University"], var_name="Metric", value_name="Value")
             csv_data["Year"] = year
             csv_data["Subject"] = os.path.splitext(os.path.basename(file))[0]
             data.append(csv_data)
-    return pd.concat(data, axis=0)
+    return pd.concat(data, axis=0) if data else None # None if there's no data for any of the years
+
+def numeric_values(values):
+    """
+    Convert values to numbers by parsing each unique value once, also returning the values which couldn't be converted
+    """
+    codes, uniques = pd.factorize(values)
+    numbers = pd.to_numeric([numeric_spec.sub("", str(value)) for value in uniques], errors="coerce") # Coerce will turn blanks to NaNs
+    coerced = [str(value) for value, number in zip(uniques, numbers) if np.isnan(number)]
+    numbers = np.append(numbers, np.nan) # Missing values have a code of -1 so pick up the trailing NaN
+    return pd.Series(numbers[codes], index=values.index), coerced
 
 def clean_data(data):
     """
@@ -61,18 +165,12 @@ def clean_data(data):
     data["Institution"] = data["University"].apply(lambda x: BeautifulSoup(x, "lxml").get_text())
     data["Metric"] = data["Metric"].apply(lambda x: BeautifulSoup(x, "lxml").get_text())
     data.drop("University", axis=1, inplace=True)
-    data["Metric"].replace({
-        "Overall rating": "Total score",
-        "Entry standards": "Entry points",
-        "Research rating": "Research quality"
-    }, inplace=True)
+    data["Metric"].replace(metric_names, inplace=True)
     data = data.loc[data["Metric"] != "Subject rank"] # Rank is dropped in favour of re-calculating it on the 'Total' metric
     data = data.loc[data["Metric"] != "Overall rank"]
-    data["Numeric Value"] = data["Value"].astype(str)
-    data["Numeric Value"] = data["Numeric Value"].str.replace("%", "", regex=False)
-    data["Numeric Value"] = data["Numeric Value"].str.replace("*", "", regex=False)
-    data["Numeric Value"] = data["Numeric Value"].str.replace("..", "", regex=False)
-    data["Numeric Value"] = pd.to_numeric(data["Numeric Value"], errors="coerce") # Coerce will turn blanks to NaNs
+    data["Numeric Value"], coerced = numeric_values(data["Value"])
+    if coerced:
+        print("Values converted to NaN:", ", ".join(sorted(coerced)))
     return data
 
 def rank_metrics(data):
@@ -85,10 +183,36 @@ def rank_metrics(data):
     )
     return data
 
+def write_csv(data, file, header):
+    """
+    Save ranked data to the output CSV (gzipped if the filename ends in .gz) with a fixed column order, starting the file if header is True
+    """
+    data[columns].to_csv(file, mode="w" if header else "a", header=header, index=False, float_format=float_format)
+
+output = "Times & Sunday Times Subject.csv" # Add .gz to the filename to save compressed
+columns = ["Metric", "Value", "Year", "Subject", "Institution", "Numeric Value", "Rank", "Decile"]
+float_format = "%.10g" # Fixed float formatting so that values don't depend on binary rounding
+
 years = [2014, 2015, 2016, 2017, 2018, 2019, 2020]
-fetch_json(years)
-json_to_csv(years)
-data = concat_data(years)
-data = clean_data(data)
-data = rank_metrics(data)
-data.to_csv("Times & Sunday Times Subject.csv", index=False) # Save final CSV to disk
+
+def main(years):
+    fetch_json(years)
+    json_to_csv(years)
+    check_schema(years)
+    partial = "." + output # Years are appended to a hidden copy, which only replaces the output once every year has been written
+    header = True
+    for year in years: # Each year is ranked separately (ranks are always within a year) so only one year is held in memory
+        data = concat_data([year])
+        if data is None:
+            print("No data for", year)
+            continue
+        data = clean_data(data)
+        data = rank_metrics(data)
+        write_csv(data, partial, header)
+        header = False
+    if header:
+        raise ValueError("No data for any of {}".format(", ".join(str(y) for y in years)))
+    os.replace(partial, output)
+
+if __name__ == "__main__":
+    main(years)